@@ -1,404 +1,60 @@
 import os
-import random
-import torch
-import gradio as gr
 import shutil
-from datetime import datetime
-from kokoro import KModel, KPipeline
-from tqdm import tqdm
-from scipy.io.wavfile import write, read
-import subprocess
-import warnings
-
-# Set explicit cache directories to ensure consistent caching
-cache_base = os.path.abspath(os.path.join(os.getcwd(), 'cache'))
-os.environ["HF_HOME"] = os.path.abspath(os.path.join(cache_base, 'HF_HOME'))
-os.environ["TORCH_HOME"] = os.path.abspath(os.path.join(cache_base, 'TORCH_HOME'))
-os.environ["TRANSFORMERS_CACHE"] = os.environ["HF_HOME"]
-os.environ["HF_DATASETS_CACHE"] = os.environ["HF_HOME"]
-os.environ["HF_HUB_DISABLE_SYMLINKS_WARNING"] = "1"
+import inspect
+import functools
+import torch
+from audio_writer import soft_limit, to_float32
+from engine import (
+    EngineError, CHOICES, BACKENDS, BACKEND, SCHEDULER_ENABLED, SCHEDULER_MAX_BATCH, output_folder, custom_voices_folder,
+    voice_store, get_custom_voices, update_voice_choices, generate_first, generate_first_stream,
+    get_new_voice, get_mixed_voice, parse_conversation_script, generate_conversation_from_script,
+    batch_convert_text_files_with_voices, debug_custom_voices,
+)
 
 # Set Gradio temp directory to our outputs folder to avoid duplicate file storage
-output_folder = os.path.join(os.getcwd(), 'outputs')
 os.environ["GRADIO_TEMP_DIR"] = os.path.abspath(output_folder)
-# Add these environment variables to prevent redownloading models each time
-os.environ["TRANSFORMERS_OFFLINE"] = "1"
-os.environ["HF_HUB_OFFLINE"] = "1"
-
-print(f"Using cache directory: {os.environ['HF_HOME']}")
-
-torch.nn.utils.parametrize = torch.nn.utils.parametrizations.weight_norm
-warnings.filterwarnings("ignore", category=UserWarning, module="torch.nn.modules.rnn")
-warnings.filterwarnings("ignore", category=FutureWarning, module="torch.nn.utils.weight_norm")
-
-CUDA_AVAILABLE = torch.cuda.is_available()
-
-try:
-    # First run - download models if they don't exist
-    if not os.path.exists(os.path.join(cache_base, 'HF_HOME/hub/models--hexgrad--Kokoro-82M')):
-        print("First run detected, downloading models...")
-        # Temporarily disable offline mode to allow downloads
-        os.environ.pop("TRANSFORMERS_OFFLINE", None)
-        os.environ.pop("HF_HUB_OFFLINE", None)
-        
-    # Load models with environment variables controlling cache location
-    models = {gpu: KModel(repo_id="hexgrad/Kokoro-82M").to('cuda' if gpu else 'cpu').eval() for gpu in [True]}
-    if CUDA_AVAILABLE:
-        print("Model loaded to GPU.")
-    else:
-        print("Model loaded to CPU.")
-
-    # Load pipelines with environment variables controlling cache location
-    pipelines = {lang_code: KPipeline(repo_id="hexgrad/Kokoro-82M", lang_code=lang_code, model=False) for lang_code in 'abpi'}
-    pipelines['a'].g2p.lexicon.golds['kokoro'] = 'kˈOkəɹO'
-    pipelines['b'].g2p.lexicon.golds['kokoro'] = 'kˈQkəɹQ'
-    # Add try-except for Italian pipeline which might not have lexicon attribute
-    try:
-        if hasattr(pipelines['i'].g2p, 'lexicon'):
-            pipelines['i'].g2p.lexicon.golds['kokoro'] = 'kˈkɔro'
-        else:
-            print("Warning: Italian pipeline g2p doesn't have lexicon attribute, skipping custom pronunciation")
-    except Exception as e:
-        print(f"Warning: Could not set custom pronunciation for Italian: {str(e)}")
-    
-    # After successful loading, re-enable offline mode to prevent future download attempts
-    os.environ["TRANSFORMERS_OFFLINE"] = "1"
-    os.environ["HF_HUB_OFFLINE"] = "1"
-    
-except Exception as e:
-    print(f"Error during model loading: {str(e)}")
-    print("Attempting to load in online mode...")
-    # If offline loading fails, try online mode
-    os.environ.pop("TRANSFORMERS_OFFLINE", None)
-    os.environ.pop("HF_HUB_OFFLINE", None)
-    
-    # Load models with environment variables controlling cache location
-    models = {gpu: KModel(repo_id="hexgrad/Kokoro-82M").to('cuda' if gpu else 'cpu').eval() for gpu in [True]}
-    if CUDA_AVAILABLE:
-        print("Model loaded to GPU.")
-    else:
-        print("Model loaded to CPU.")
-
-    # Load pipelines with environment variables controlling cache location
-    pipelines = {lang_code: KPipeline(repo_id="hexgrad/Kokoro-82M", lang_code=lang_code, model=False) for lang_code in 'abpi'}
-    pipelines['a'].g2p.lexicon.golds['kokoro'] = 'kˈOkəɹO'
-    pipelines['b'].g2p.lexicon.golds['kokoro'] = 'kˈQkəɹQ'
-    # Add try-except for Italian pipeline which might not have lexicon attribute
-    try:
-        if hasattr(pipelines['i'].g2p, 'lexicon'):
-            pipelines['i'].g2p.lexicon.golds['kokoro'] = 'kˈkɔro'
-        else:
-            print("Warning: Italian pipeline g2p doesn't have lexicon attribute, skipping custom pronunciation")
-    except Exception as e:
-        print(f"Warning: Could not set custom pronunciation for Italian: {str(e)}")
-
-# Store loaded voices to avoid reloading
-loaded_voices = {}
-
-CHAR_LIMIT = 5000
-
-custom_voices_folder = os.path.join(os.getcwd(), 'custom_voices')
-
-# Create output folder if it doesn't exist (already defined above for GRADIO_TEMP_DIR)
-if not os.path.exists(output_folder):
-    os.makedirs(output_folder)
-
-if not os.path.exists(custom_voices_folder):
-    os.makedirs(custom_voices_folder)
-
-CHOICES = {
-    '🇺🇸 🚺 Heart ❤️': 'af_heart',
-    '🇺🇸 🚺 Bella 🔥': 'af_bella',
-    '🇺🇸 🚺 Nicole 🎧': 'af_nicole',
-    '🇺🇸 🚺 Aoede': 'af_aoede',
-    '🇺🇸 🚺 Kore': 'af_kore',
-    '🇺🇸 🚺 Sarah': 'af_sarah',
-    '🇺🇸 🚺 Nova': 'af_nova',
-    '🇺🇸 🚺 Sky': 'af_sky',
-    '🇺🇸 🚺 Alloy': 'af_alloy',
-    '🇺🇸 🚺 Jessica': 'af_jessica',
-    '🇺🇸 🚺 River': 'af_river',
-    '🇺🇸 🚹 Michael': 'am_michael',
-    '🇺🇸 🚹 Fenrir': 'am_fenrir',
-    '🇺🇸 🚹 Puck': 'am_puck',
-    '🇺🇸 🚹 Echo': 'am_echo',
-    '🇺🇸 🚹 Eric': 'am_eric',
-    '🇺🇸 🚹 Liam': 'am_liam',
-    '🇺🇸 🚹 Onyx': 'am_onyx',
-    '🇺🇸 🚹 Santa': 'am_santa',
-    '🇺🇸 🚹 Adam': 'am_adam',
-    '🇬🇧 🚺 Emma': 'bf_emma',
-    '🇬🇧 🚺 Isabella': 'bf_isabella',
-    '🇬🇧 🚺 Alice': 'bf_alice',
-    '🇬🇧 🚺 Lily': 'bf_lily',
-    '🇬🇧 🚹 George': 'bm_george',
-    '🇬🇧 🚹 Fable': 'bm_fable',
-    '🇬🇧 🚹 Lewis': 'bm_lewis',
-    '🇬🇧 🚹 Daniel': 'bm_daniel',
-    'PF 🚺 Dora': 'pf_dora',
-    'PM 🚹 Alex': 'pm_alex',
-    'PM 🚹 Santa': 'pm_santa',
-    '🇮🇹 🚺 Sara': 'if_sara',
-    '🇮🇹 🚹 Nicola': 'im_nicola',
-}
-
-# Function to get custom voices from the custom_voices folder
-def get_custom_voices():
-    custom_voices = {}
-    if os.path.exists(custom_voices_folder):
-        for file in os.listdir(custom_voices_folder):
-            file_path = os.path.join(custom_voices_folder, file)
-            # Check if it's a .pt file (PyTorch model file)
-            if file.endswith('.pt') and os.path.isfile(file_path):
-                voice_id = os.path.splitext(file)[0]  # Remove the .pt extension
-                custom_voices[f'👤 Custom: {voice_id}'] = f'custom_{voice_id}'
-    return custom_voices
-
-# Update choices with custom voices
-def update_voice_choices():
-    updated_choices = CHOICES.copy()
-    custom_voices = get_custom_voices()
-    updated_choices.update(custom_voices)
-    return updated_choices
+import gradio as gr
 
-def preload_voices():
-    print("Preloading voices...")
-    for voice_name, voice_id in CHOICES.items():
-        print(f"Loading voice: {voice_name} ({voice_id})")
-        pipeline = pipelines[voice_id[0]]
-        try:
-            voice_pack = pipeline.load_voice(voice_id)
-            loaded_voices[voice_id] = voice_pack
-            print(f"Successfully loaded voice: {voice_name}")
-        except Exception as e:
-            print(f"Error loading voice {voice_name}: {str(e)}")
-    
-    # Load custom voices if any
-    custom_voices = get_custom_voices()
-    for voice_name, voice_id in custom_voices.items():
-        try:
-            # Custom voices use the American English pipeline by default
-            pipeline = pipelines['a']
-            voice_file = f"{voice_id.split('_')[1]}.pt"
-            voice_path = os.path.join(custom_voices_folder, voice_file)
-            
-            # Check if the file exists
-            if not os.path.exists(voice_path):
-                print(f"Custom voice file not found: {voice_file}")
-                continue
-            
-            # Load the .pt file directly
+def show_engine_errors(fn):
+    """Re-raise engine errors as gr.Error so Gradio shows their message to the user"""
+    if inspect.isgeneratorfunction(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
             try:
-                voice_pack = torch.load(voice_path, weights_only=True)
-                loaded_voices[voice_id] = voice_pack
-                print(f"Successfully loaded custom voice: {voice_name}")
-            except Exception as e:
-                print(f"Error loading custom voice {voice_name}: {str(e)}")
-        except Exception as e:
-            print(f"Error loading custom voice {voice_name}: {str(e)}")
-    
-    print(f"All voices preloaded successfully. Total voices in cache: {len(loaded_voices)}")
-
-preload_voices()
-
-def forward(ps, ref_s, speed):
-    try:
-        if CUDA_AVAILABLE:
-            return models[True](ps, ref_s, speed)
-        else:
-            return models[False](ps, ref_s, speed)
-    except Exception as e:
-        print(f"Error with GPU processing: {e}. Falling back to CPU.")
-        return models[False](ps, ref_s, speed)
-
-def convert_to_mp3(input_wav_path, output_mp3_path, bitrate="192k"):
-    """Convert WAV file to MP3 using ffmpeg"""
-    try:
-        # Import ffmpeg from imageio
-        import imageio_ffmpeg as ffmpeg
-        
-        # Get ffmpeg executable path
-        ffmpeg_path = ffmpeg.get_ffmpeg_exe()
-        
-        # Get input file size for progress info
-        input_size_mb = os.path.getsize(input_wav_path) / (1024 * 1024)
-        print(f"🔄 Converting {input_size_mb:.1f} MB WAV to MP3 (bitrate: {bitrate})...")
-        
-        # Build ffmpeg command
-        cmd = [
-            ffmpeg_path,
-            '-i', input_wav_path,
-            '-codec:a', 'libmp3lame',
-            '-b:a', bitrate,
-            '-y',  # Overwrite output file if it exists
-            output_mp3_path
-        ]
-        
-        print(f"⚙️  Running FFmpeg conversion...")
-        # Run ffmpeg command
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        
-        if result.returncode == 0:
-            print(f"✅ MP3 conversion completed successfully!")
-            return True
-        else:
-            print(f"❌ FFmpeg conversion failed!")
-            print(f"Error details: {result.stderr}")
-            return False
-            
-    except ImportError:
-        print("❌ imageio-ffmpeg not available. Please install it with: pip install imageio-ffmpeg")
-        return False
-    except Exception as e:
-        print(f"❌ Error during MP3 conversion: {str(e)}")
-        return False
-
-def generate_first(text, voice='af_heart', speed=1, output_format='WAV'):
-    text = text.strip()
-    
-    # Check if the voice is a display name from standard voices
-    if voice in CHOICES:
-        voice = CHOICES[voice]
-    # Check if the voice is a custom voice display name
-    elif voice.startswith('👤 Custom:'):
-        custom_voices = get_custom_voices()
-        if voice in custom_voices:
-            voice = custom_voices[voice]
-        else:
-            raise gr.Error(f"Custom voice not found: {voice}")
-    
-    chunks = [text[i:i + CHAR_LIMIT] for i in range(0, len(text), CHAR_LIMIT)]
-    
-    audio_output = []
-    ps_output = []
-
-    # Determine if this is a custom voice
-    is_custom = voice.startswith('custom_')
-    
-    # Use the appropriate pipeline
-    if is_custom:
-        pipeline = pipelines['a']  # Use American English pipeline for custom voices
-    else:
-        pipeline = pipelines[voice[0]]
-    
-    # Get voice from in-memory cache or load it
-    if voice in loaded_voices:
-        pack = loaded_voices[voice]
-        print(f"Using cached voice: {voice}")
+                yield from fn(*args, **kwargs)
+            except EngineError as e:
+                raise gr.Error(str(e))
     else:
-        print(f"Voice {voice} not found in cache, loading now...")
-        if is_custom:
-            # Load custom voice from the custom_voices folder
-            voice_name = voice.split('_')[1]
-            voice_file = f"{voice_name}.pt"
-            voice_path = os.path.join(custom_voices_folder, voice_file)
-            
-            # Check if the file exists
-            if not os.path.exists(voice_path):
-                raise gr.Error(f"Custom voice file not found: {voice_file}")
-            
-            # Load the .pt file directly
-            try:
-                pack = torch.load(voice_path, weights_only=True)
-            except Exception as e:
-                raise gr.Error(f"Error loading custom voice: {str(e)}")
-        else:
-            pack = pipeline.load_voice(voice)
-        loaded_voices[voice] = pack
-    
-    for chunk in tqdm(chunks, desc="Processing chunks", ncols=100):
-        for _, ps, _ in pipeline(chunk, voice if not is_custom else None, speed):
-            ref_s = pack[len(ps)-1]
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
             try:
-                audio = forward(ps, ref_s, speed)
-            except gr.exceptions.Error as e:
-                gr.Warning(str(e))
-                gr.Info('Retrying with CPU.')
-                audio = models[False](ps, ref_s, speed)
-            
-            audio_output.append(torch.tensor(audio.numpy()))
-            ps_output.append(ps)
-    
-    audio_combined = torch.cat(audio_output, dim=-1)
-    
-    audio_combined_numpy = audio_combined.detach().cpu().numpy()
+                return fn(*args, **kwargs)
+            except EngineError as e:
+                raise gr.Error(str(e))
+    return wrapper
 
-    phoneme_sequence = '\n'.join(ps_output)
-
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    
-    # Calculate file size information
-    audio_length_seconds = len(audio_combined_numpy) / 24000
-    estimated_wav_size_mb = (len(audio_combined_numpy) * 2) / (1024 * 1024)  # 16-bit audio
-    
-    print(f"Audio generation complete!")
-    print(f"Audio length: {audio_length_seconds:.1f} seconds ({audio_length_seconds/60:.1f} minutes)")
-    print(f"Estimated WAV file size: {estimated_wav_size_mb:.1f} MB")
-    
-    # Handle different output formats
-    if output_format.upper() == 'MP3':
-        # Save as WAV first, then convert to MP3
-        wav_filename = f"audio_{timestamp}.wav"
-        wav_filepath = os.path.join(output_folder, wav_filename)
-        
-        print(f"Saving audio as WAV file: {wav_filename}")
-        write(wav_filepath, 24000, audio_combined_numpy)
-        actual_wav_size_mb = os.path.getsize(wav_filepath) / (1024 * 1024)
-        print(f"WAV file saved successfully! Actual size: {actual_wav_size_mb:.1f} MB")
-        
-        # Convert to MP3
-        audio_filename = f"audio_{timestamp}.mp3"
-        audio_filepath = os.path.join(output_folder, audio_filename)
-        
-        print(f"Starting MP3 conversion...")
-        print(f"Converting: {wav_filename} → {audio_filename}")
-        
-        # Use ffmpeg for conversion
-        if convert_to_mp3(wav_filepath, audio_filepath):
-            # Check MP3 file size
-            mp3_size_mb = os.path.getsize(audio_filepath) / (1024 * 1024)
-            compression_ratio = (actual_wav_size_mb / mp3_size_mb) if mp3_size_mb > 0 else 0
-            print(f"MP3 conversion successful!")
-            print(f"MP3 file size: {mp3_size_mb:.1f} MB (compression ratio: {compression_ratio:.1f}x)")
-            
-            # Try to remove the WAV file after successful conversion
-            try:
-                os.remove(wav_filepath)
-                print(f"Temporary WAV file removed: {wav_filename}")
-                print(f"Final output: {audio_filename}")
-            except PermissionError:
-                print(f"Warning: Could not delete WAV file (file in use): {wav_filename}")
-                print("The MP3 conversion was successful. You can manually delete the WAV file later.")
-            except Exception as e:
-                print(f"Warning: Could not delete WAV file: {str(e)}")
-        else:
-            # If MP3 conversion fails, keep the WAV file and return it
-            print("MP3 conversion failed. Keeping WAV format.")
-            audio_filename = wav_filename
-            audio_filepath = wav_filepath
-    else:
-        # Default WAV format
-        audio_filename = f"audio_{timestamp}.wav"
-        audio_filepath = os.path.join(output_folder, audio_filename)
-        
-        print(f"Saving audio as WAV file: {audio_filename}")
-        write(audio_filepath, 24000, audio_combined_numpy)
-        actual_wav_size_mb = os.path.getsize(audio_filepath) / (1024 * 1024)
-        print(f"WAV file saved successfully! Size: {actual_wav_size_mb:.1f} MB")
+def to_pcm16(audio):
+    """Convert a float audio tensor to 16-bit PCM for streaming playback, limiting peaks like saved files"""
+    return (soft_limit(to_float32(audio)) * 32767).round().astype('int16')
 
-    # Check if file is too large for proper waveform display
-    final_file_size_mb = os.path.getsize(audio_filepath) / (1024 * 1024)
-    is_large_file = final_file_size_mb > 50  # Consider files over 50MB as large
-    
-    if is_large_file:
-        print(f"⚠️  Large file generated ({final_file_size_mb:.1f} MB)")
-        print(f"📁 File location: {audio_filepath}")
-        print(f"💡 Note: Large files may not display waveforms properly in the browser.")
-        print(f"   You can access the full file directly from the outputs folder.")
-    
-    print(f"🎵 Generation complete! Total processing time for {len(chunks)} chunks.")
+@show_engine_errors
+def generate_speech(text, voice='af_heart', speed=1, output_format='WAV', stream=False, backend=None):
+    """Generate Speech button handler, streaming each segment as it is synthesized when requested"""
+    if not stream:
+        audio_filepath, phoneme_sequence, is_large_file = generate_first(text, voice, speed, output_format, backend)
+        yield gr.update(), audio_filepath, phoneme_sequence, gr.update(visible=is_large_file)
+        return
+    
+    segments = generate_first_stream(text, voice, speed, output_format, backend)
+    while True:
+        try:
+            audio = next(segments)
+        except StopIteration as done:
+            audio_filepath, phoneme_sequence, is_large_file = done.value
+            break
+        yield (24000, to_pcm16(audio)), gr.update(), gr.update(), gr.update()
     
-    return audio_filepath, phoneme_sequence, gr.update(visible=is_large_file)
+    yield gr.update(), audio_filepath, phoneme_sequence, gr.update(visible=is_large_file)
 
 # Function to handle custom voice upload
 def upload_custom_voice(files, voice_name):
@@ -449,7 +105,7 @@ def upload_custom_voice(files, voice_name):
         if isinstance(voice_pack, (list, tuple)) and (len(voice_pack) == 0 or not isinstance(voice_pack[0], torch.Tensor)):
             raise ValueError("The voice file does not contain valid tensor data")
             
-        loaded_voices[voice_id] = voice_pack
+        voice_store.put(voice_id, voice_pack)
         return f"Custom voice '{voice_name}' uploaded and loaded successfully!"
     except Exception as e:
         # If loading fails, remove the file
@@ -477,74 +133,26 @@ def get_custom_voice_list():
     custom_voices = get_custom_voices()
     if not custom_voices:
         return [["No custom voices found", "N/A"]]
-    return [[name.replace('👤 Custom: ', ''), "Loaded"] for name in custom_voices.keys()]
-
-# Add voice mixing functionality
-def parse_voice_formula(formula):
-    if not formula.strip():
-        raise ValueError("Empty voice formula")
-    
-    weighted_sum = None
-    terms = formula.split('+')
-    weights = 0
-    
-    for term in terms:
-        parts = term.strip().split('*')
-        if len(parts) != 2:
-            raise ValueError(f"Invalid term format: {term.strip()}")
-        
-        voice_name = parts[0].strip()
-        weight = float(parts[1].strip())
-        weights += weight
-        
-        if voice_name not in loaded_voices:
-            raise ValueError(f"Unknown voice: {voice_name}")
-        
-        voice_tensor = loaded_voices[voice_name]
-        
-        if weighted_sum is None:
-            weighted_sum = weight * voice_tensor
-        else:
-            weighted_sum += weight * voice_tensor
-    
-    return weighted_sum / weights
+    return [[name.replace('👤 Custom: ', ''), "Loaded" if voice_id in voice_store else "Available"] for name, voice_id in custom_voices.items()]
 
-def get_new_voice(formula, custom_name=""):
+def generate_mixed_voice(formula_text, voice_name="", text_input="", save_voice=False):
     try:
-        weighted_voices = parse_voice_formula(formula)
+        # Mixes are built in memory; the formula itself works as a voice
+        voice_id, voice_pack = get_mixed_voice(formula_text)
+        status = f"Mixed voice ready: {voice_id}"
         
-        # Create a filename with custom name or timestamp if no name provided
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        if custom_name and custom_name.strip():
-            # Sanitize custom name (remove spaces and special characters)
-            custom_name = ''.join(c for c in custom_name if c.isalnum() or c == '_')
-            voice_name = f"{custom_name}"
-        else:
-            voice_name = f"mixed_{timestamp}"
-            
-        voice_pack_name = os.path.join(custom_voices_folder, f"{voice_name}.pt")
-        
-        torch.save(weighted_voices, voice_pack_name)
-        return voice_pack_name, voice_name
-    except Exception as e:
-        raise gr.Error(f"Failed to create voice: {str(e)}")
-
-def generate_mixed_voice(formula_text, voice_name="", text_input=""):
-    try:
-        # Create the mixed voice file with custom name
-        voice_file_path, voice_name = get_new_voice(formula_text, voice_name)
-        voice_id = f"custom_{voice_name}"
-        
-        # Load the voice into memory to ensure it's available
-        voice_pack = torch.load(voice_file_path, weights_only=True)
-        loaded_voices[voice_id] = voice_pack
+        if save_voice:
+            # Save the mixed voice file with custom name
+            _, voice_name = get_new_voice(formula_text, voice_name)
+            voice_store.put(f"custom_{voice_name}", voice_pack)
+            status = f"Mixed voice '{voice_name}' created successfully! You can now select it from the voice dropdown as '👤 Custom: {voice_name}'"
         
         # If text input is provided, generate audio with the mixed voice
         if text_input.strip():
             audio_path, _, _ = generate_first(text_input, voice_id)
-            return f"Mixed voice '{voice_name}' created successfully! You can now select it from the voice dropdown as '👤 Custom: {voice_name}'", audio_path
+            return status, audio_path
         else:
-            return f"Mixed voice '{voice_name}' created successfully! You can now select it from the voice dropdown as '👤 Custom: {voice_name}'", None
+            return status, None
     except Exception as e:
         raise gr.Error(f"Failed to generate mixed voice: {e}")
 
@@ -578,210 +186,6 @@ def build_formula_from_sliders(*args):
     
     return " + ".join(formula_parts)
 
-# Helper function to generate audio without saving to disk
-def generate_audio_in_memory(text, voice, speed=1):
-    """Generate audio without saving intermediate files"""
-    text = text.strip()
-    
-    # Check if the voice is a display name from standard voices
-    if voice in CHOICES:
-        voice = CHOICES[voice]
-    # Check if the voice is a custom voice display name
-    elif voice.startswith('👤 Custom:'):
-        custom_voices = get_custom_voices()
-        if voice in custom_voices:
-            voice = custom_voices[voice]
-        else:
-            raise gr.Error(f"Custom voice not found: {voice}")
-    
-    chunks = [text[i:i + CHAR_LIMIT] for i in range(0, len(text), CHAR_LIMIT)]
-    
-    audio_output = []
-
-    # Determine if this is a custom voice
-    is_custom = voice.startswith('custom_')
-    
-    # Use the appropriate pipeline
-    if is_custom:
-        pipeline = pipelines['a']  # Use American English pipeline for custom voices
-    else:
-        pipeline = pipelines[voice[0]]
-    
-    # Get voice from in-memory cache or load it
-    if voice in loaded_voices:
-        pack = loaded_voices[voice]
-    else:
-        if is_custom:
-            # Load custom voice from the custom_voices folder
-            voice_name = voice.split('_')[1]
-            voice_file = f"{voice_name}.pt"
-            voice_path = os.path.join(custom_voices_folder, voice_file)
-            
-            # Check if the file exists
-            if not os.path.exists(voice_path):
-                raise gr.Error(f"Custom voice file not found: {voice_file}")
-            
-            # Load the .pt file directly
-            try:
-                pack = torch.load(voice_path, weights_only=True)
-            except Exception as e:
-                raise gr.Error(f"Error loading custom voice: {str(e)}")
-        else:
-            pack = pipeline.load_voice(voice)
-        loaded_voices[voice] = pack
-    
-    for chunk in chunks:
-        for _, ps, _ in pipeline(chunk, voice if not is_custom else None, speed):
-            ref_s = pack[len(ps)-1]
-            try:
-                audio = forward(ps, ref_s, speed)
-            except gr.exceptions.Error as e:
-                gr.Warning(str(e))
-                gr.Info('Retrying with CPU.')
-                audio = models[False](ps, ref_s, speed)
-            
-            audio_output.append(torch.tensor(audio.numpy()))
-    
-    # Return combined audio as tensor
-    audio_combined = torch.cat(audio_output, dim=-1)
-    return audio_combined
-
-# Function to parse conversation script
-def parse_conversation_script(script_text):
-    """Parse a conversation script and extract speakers and their lines"""
-    if not script_text.strip():
-        return []
-    
-    lines = script_text.strip().split('\n')
-    conversation = []
-    current_speaker = None
-    current_text = []
-    
-    for line in lines:
-        line = line.strip()
-        if not line:
-            continue
-            
-        # Check if line starts with "Speaker X:" pattern
-        if ':' in line:
-            # Check if it's a speaker line
-            potential_speaker = line.split(':', 1)[0].strip()
-            if potential_speaker.lower().startswith('speaker') or len(potential_speaker.split()) <= 3:
-                # Save previous speaker's text if any
-                if current_speaker and current_text:
-                    conversation.append((current_speaker, ' '.join(current_text)))
-                
-                # Start new speaker
-                current_speaker = potential_speaker
-                current_text = [line.split(':', 1)[1].strip()]
-            else:
-                # Not a speaker line, add to current text
-                if current_speaker:
-                    current_text.append(line)
-        else:
-            # Continuation of current speaker's text
-            if current_speaker:
-                current_text.append(line)
-    
-    # Add the last speaker's text
-    if current_speaker and current_text:
-        conversation.append((current_speaker, ' '.join(current_text)))
-    
-    return conversation
-
-def trim_silence(audio_tensor, threshold=0.01):
-    """Trim silence from the beginning and end of audio"""
-    # Find first and last non-silent samples
-    non_silent = torch.abs(audio_tensor) > threshold
-    if not torch.any(non_silent):
-        return audio_tensor  # Return original if all silent
-    
-    # Find first and last non-silent indices
-    first_sound = torch.where(non_silent)[0][0]
-    last_sound = torch.where(non_silent)[0][-1]
-    
-    # Trim with small padding to avoid cutting off audio
-    padding = int(24000 * 0.05)  # 50ms padding
-    start = max(0, first_sound - padding)
-    end = min(len(audio_tensor), last_sound + padding)
-    
-    return audio_tensor[start:end]
-
-def batch_convert_text_files_with_voices(files, speed, output_format, *voice_assignments):
-    """Convert multiple text files to audio using individual voice settings for each file"""
-    if not files:
-        raise gr.Error("Please upload at least one text file.")
-    
-    results = []
-    audio_files = []  # Store paths to generated audio files
-    total_files = len(files)
-    
-    print(f"Starting batch conversion of {total_files} files...")
-    
-    for i, file_path in enumerate(files):
-        try:
-            print(f"Processing file {i+1}/{total_files}: {os.path.basename(file_path)}")
-            
-            # Read the text file
-            with open(file_path, 'r', encoding='utf-8') as f:
-                text_content = f.read().strip()
-            
-            if not text_content:
-                print(f"Skipping empty file: {os.path.basename(file_path)}")
-                results.append(f"❌ {os.path.basename(file_path)}: Empty file")
-                audio_files.append(None)
-                continue
-            
-            # Get the voice for this specific file
-            voice = voice_assignments[i] if i < len(voice_assignments) and voice_assignments[i] else list(update_voice_choices().keys())[0]
-            
-            # Generate audio for this text with the assigned voice
-            audio_path, _, _ = generate_first(text_content, voice, speed, output_format)
-            
-            # Rename the output file to match the input filename
-            input_filename = os.path.splitext(os.path.basename(file_path))[0]
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            
-            if output_format.upper() == 'MP3':
-                new_filename = f"{input_filename}_{timestamp}.mp3"
-            else:
-                new_filename = f"{input_filename}_{timestamp}.wav"
-            
-            new_audio_path = os.path.join(output_folder, new_filename)
-            
-            # Rename the generated file
-            if os.path.exists(audio_path):
-                os.rename(audio_path, new_audio_path)
-                file_size_mb = os.path.getsize(new_audio_path) / (1024 * 1024)
-                
-                # Get voice display name for results
-                voice_display = voice if voice in update_voice_choices() else voice
-                results.append(f"✅ {os.path.basename(file_path)} → {new_filename} ({file_size_mb:.1f} MB) [Voice: {voice_display}]")
-                audio_files.append(new_audio_path)
-                print(f"✅ Completed: {new_filename} with voice: {voice}")
-            else:
-                results.append(f"❌ {os.path.basename(file_path)}: Audio generation failed")
-                audio_files.append(None)
-                
-        except Exception as e:
-            error_msg = f"❌ {os.path.basename(file_path)}: {str(e)}"
-            results.append(error_msg)
-            audio_files.append(None)
-            print(f"Error processing {os.path.basename(file_path)}: {str(e)}")
-    
-    # Create summary
-    successful = len([r for r in results if r.startswith("✅")])
-    failed = len([r for r in results if r.startswith("❌")])
-    
-    summary = f"Batch conversion completed!\n"
-    summary += f"✅ Successful: {successful}/{total_files}\n"
-    summary += f"❌ Failed: {failed}/{total_files}\n\n"
-    summary += "Results:\n" + "\n".join(results)
-    
-    print(f"Batch conversion completed: {successful} successful, {failed} failed")
-    
-    return summary, audio_files
-
 def update_file_voice_assignments(files):
     """Update the voice assignment interface when files are uploaded"""
     if not files:
@@ -840,139 +244,6 @@ def update_batch_audio_players(audio_files):
     
     return [audio_column_update] + updates
 
-def generate_conversation_from_script(script_text, speaker_voices, pause_duration, default_speed, output_format='WAV'):
-    """Generate conversation audio from a script with assigned voices"""
-    conversation = parse_conversation_script(script_text)
-    
-    if not conversation:
-        raise gr.Error("No conversation found. Please enter a script in the format:\nSpeaker 1: Hello\nSpeaker 2: Hi there")
-    
-    # Get unique speakers
-    speakers = list(set([speaker for speaker, _ in conversation]))
-    
-    # Check if all speakers have assigned voices
-    missing_voices = [speaker for speaker in speakers if speaker not in speaker_voices or not speaker_voices[speaker]]
-    if missing_voices:
-        raise gr.Error(f"Please assign voices for: {', '.join(missing_voices)}")
-    
-    audio_segments = []
-    conversation_script = []
-    
-    for i, (speaker, text) in enumerate(conversation):
-        if not text.strip():
-            continue
-            
-        # Update conversation script
-        conversation_script.append(f"{speaker}: {text}")
-        
-        # Get voice for this speaker
-        voice = speaker_voices.get(speaker)
-        if not voice:
-            continue
-            
-        # Debug: Print voice information
-        print(f"Processing speaker '{speaker}' with voice '{voice}'")
-        if voice.startswith('👤 Custom:'):
-            custom_voice_name = voice.replace('👤 Custom: ', '')
-            custom_voice_file = f"{custom_voice_name}.pt"
-            custom_voice_path = os.path.join(custom_voices_folder, custom_voice_file)
-            print(f"Custom voice file path: {custom_voice_path}")
-            print(f"File exists: {os.path.exists(custom_voice_path)}")
-            if not os.path.exists(custom_voice_path):
-                # List available custom voice files
-                available_files = [f for f in os.listdir(custom_voices_folder) if f.endswith('.pt')] if os.path.exists(custom_voices_folder) else []
-                raise gr.Error(f"Custom voice file '{custom_voice_file}' not found in custom_voices folder.\nAvailable custom voice files: {available_files}")
-            
-        # Generate audio for this speaker in memory (no intermediate files saved)
-        try:
-            audio_tensor = generate_audio_in_memory(text, voice, default_speed)
-            
-            # Normalize audio
-            if audio_tensor.max() > 1.0:
-                audio_tensor = audio_tensor / audio_tensor.max()
-            
-            # Trim silence from individual audio clips
-            audio_tensor = trim_silence(audio_tensor)
-            
-            audio_segments.append(audio_tensor)
-            
-            # Handle pause between speakers (can be negative for overlap)
-            if i < len(conversation) - 1:
-                if pause_duration > 0:
-                    # Add silence
-                    pause_samples = int(24000 * pause_duration)
-                    pause_audio = torch.zeros(pause_samples)
-                    audio_segments.append(pause_audio)
-                elif pause_duration < 0:
-                    # Negative pause means trim from the end of current audio
-                    trim_samples = int(24000 * abs(pause_duration))
-                    if len(audio_segments[-1]) > trim_samples:
-                        audio_segments[-1] = audio_segments[-1][:-trim_samples]
-                # If pause_duration == 0, add no pause (direct concatenation)
-                
-        except Exception as e:
-            raise gr.Error(f"Error generating audio for {speaker}: {str(e)}")
-    
-    # Combine all audio segments
-    if audio_segments:
-        combined_audio = torch.cat(audio_segments, dim=-1)
-        combined_audio_numpy = combined_audio.detach().cpu().numpy()
-        
-        # Save the combined conversation
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        
-        # Handle different output formats
-        if output_format.upper() == 'MP3':
-            # Save as WAV first, then convert to MP3
-            wav_filename = f"conversation_{timestamp}.wav"
-            wav_filepath = os.path.join(output_folder, wav_filename)
-            write(wav_filepath, 24000, combined_audio_numpy)
-            
-            # Convert to MP3
-            conversation_filename = f"conversation_{timestamp}.mp3"
-            conversation_filepath = os.path.join(output_folder, conversation_filename)
-            
-            # Use ffmpeg for conversion
-            if convert_to_mp3(wav_filepath, conversation_filepath):
-                # Check MP3 file size
-                mp3_size_mb = os.path.getsize(conversation_filepath) / (1024 * 1024)
-                wav_size_mb = os.path.getsize(wav_filepath) / (1024 * 1024)
-                compression_ratio = (wav_size_mb / mp3_size_mb) if mp3_size_mb > 0 else 0
-                print(f"MP3 conversion successful!")
-                print(f"MP3 file size: {mp3_size_mb:.1f} MB (compression ratio: {compression_ratio:.1f}x)")
-                
-                # Try to remove the WAV file after successful conversion
-                try:
-                    os.remove(wav_filepath)
-                    print(f"Temporary WAV file removed: {wav_filename}")
-                    print(f"Final output: {conversation_filename}")
-                except PermissionError:
-                    print(f"Warning: Could not delete WAV file (file in use): {wav_filename}")
-                    print("The MP3 conversion was successful. You can manually delete the WAV file later.")
-                except Exception as e:
-                    print(f"Warning: Could not delete WAV file: {str(e)}")
-            else:
-                # If MP3 conversion fails, keep the WAV file and return it
-                print("MP3 conversion failed. Keeping WAV format.")
-                conversation_filename = wav_filename
-                conversation_filepath = wav_filepath
-        else:
-            # Default WAV format
-            conversation_filename = f"conversation_{timestamp}.wav"
-            conversation_filepath = os.path.join(output_folder, conversation_filename)
-            write(conversation_filepath, 24000, combined_audio_numpy)
-        
-        # Create conversation script text
-        script_text = "\n".join(conversation_script)
-        
-        print(f"🎬 Conversation generation complete!")
-        print(f"Only final conversation file saved: {conversation_filename}")
-        print(f"No intermediate speaker files were saved.")
-        
-        return conversation_filepath, script_text
-    else:
-        raise gr.Error("No audio generated. Please check your inputs.")
-
 def update_speaker_voices(script_text, *voice_assignments):
     """Update speaker voice assignments and return updated components"""
     conversation = parse_conversation_script(script_text)
@@ -989,121 +260,6 @@ def update_speaker_voices(script_text, *voice_assignments):
     
     return speakers, speaker_voices
 
-# Function to generate conversation audio
-def generate_conversation(speaker1_name, speaker1_voice, speaker1_text, speaker1_speed,
-                         speaker2_name, speaker2_voice, speaker2_text, speaker2_speed,
-                         speaker3_name, speaker3_voice, speaker3_text, speaker3_speed,
-                         speaker4_name, speaker4_voice, speaker4_text, speaker4_speed,
-                         speaker5_name, speaker5_voice, speaker5_text, speaker5_speed,
-                         pause_duration):
-    
-    # Collect all speakers and their data
-    speakers = [
-        (speaker1_name, speaker1_voice, speaker1_text, speaker1_speed),
-        (speaker2_name, speaker2_voice, speaker2_text, speaker2_speed),
-        (speaker3_name, speaker3_voice, speaker3_text, speaker3_speed),
-        (speaker4_name, speaker4_voice, speaker4_text, speaker4_speed),
-        (speaker5_name, speaker5_voice, speaker5_text, speaker5_speed)
-    ]
-    
-    # Filter out speakers with no text
-    active_speakers = [(name, voice, text, speed) for name, voice, text, speed in speakers if text.strip()]
-    
-    if not active_speakers:
-        raise gr.Error("Please add text for at least one speaker.")
-    
-    conversation_script = []
-    audio_segments = []
-    
-    # Generate pause audio (silence)
-    pause_samples = int(24000 * pause_duration)  # 24kHz sample rate
-    pause_audio = torch.zeros(pause_samples)
-    
-    for i, (name, voice, text, speed) in enumerate(active_speakers):
-        # Update conversation script
-        speaker_name = name.strip() if name.strip() else f"Speaker {i+1}"
-        conversation_script.append(f"{speaker_name}: {text}")
-        
-        # Generate audio for this speaker
-        try:
-            audio_path, _, _ = generate_first(text, voice, speed)
-            
-            # Load the generated audio
-            sample_rate, audio_data = read(audio_path)
-            
-            # Convert to tensor
-            audio_tensor = torch.tensor(audio_data, dtype=torch.float32)
-            
-            # Normalize audio
-            if audio_tensor.max() > 1.0:
-                audio_tensor = audio_tensor / audio_tensor.max()
-            
-            audio_segments.append(audio_tensor)
-            
-            # Add pause after each speaker (except the last one)
-            if i < len(active_speakers) - 1:
-                audio_segments.append(pause_audio)
-                
-        except Exception as e:
-            raise gr.Error(f"Error generating audio for {speaker_name}: {str(e)}")
-    
-    # Combine all audio segments
-    if audio_segments:
-        combined_audio = torch.cat(audio_segments, dim=-1)
-        combined_audio_numpy = combined_audio.detach().cpu().numpy()
-        
-        # Save the combined conversation
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        conversation_filename = f"conversation_{timestamp}.wav"
-        conversation_filepath = os.path.join(output_folder, conversation_filename)
-        
-        print(f"Saving conversation as: {conversation_filename}")
-        write(conversation_filepath, 24000, combined_audio_numpy)
-        actual_file_size_mb = os.path.getsize(conversation_filepath) / (1024 * 1024)
-        print(f"Conversation saved successfully! Size: {actual_file_size_mb:.1f} MB")
-        
-        # Create conversation script text
-        script_text = "\n".join(conversation_script)
-        
-        # Check if file is too large and provide information
-        conversation_length_seconds = len(combined_audio_numpy) / 24000
-        
-        print(f"🎬 Conversation generation complete!")
-        print(f"Total audio length: {conversation_length_seconds:.1f} seconds ({conversation_length_seconds/60:.1f} minutes)")
-        print(f"Speakers processed: {len(active_speakers)}")
-        
-        if actual_file_size_mb > 50:
-            print(f"⚠️  Large conversation file generated ({actual_file_size_mb:.1f} MB)")
-            print(f"📁 File location: {conversation_filepath}")
-            print(f"💡 Note: Large files may not display waveforms properly in the browser.")
-        
-        return conversation_filepath, script_text
-    else:
-        raise gr.Error("No audio generated. Please check your inputs.")
-
-def debug_custom_voices():
-    """Debug function to list custom voice files"""
-    print("\n=== CUSTOM VOICES DEBUG ===")
-    print(f"Custom voices folder: {custom_voices_folder}")
-    print(f"Folder exists: {os.path.exists(custom_voices_folder)}")
-    
-    if os.path.exists(custom_voices_folder):
-        all_files = os.listdir(custom_voices_folder)
-        pt_files = [f for f in all_files if f.endswith('.pt')]
-        print(f"All files in folder: {all_files}")
-        print(f"PT files found: {pt_files}")
-        
-        # Check what get_custom_voices() returns
-        custom_voices_dict = get_custom_voices()
-        print(f"get_custom_voices() result: {custom_voices_dict}")
-        
-        # Check loaded voices
-        custom_loaded = {k: v for k, v in loaded_voices.items() if k.startswith('custom_')}
-        print(f"Loaded custom voices: {list(custom_loaded.keys())}")
-    else:
-        print("Custom voices folder does not exist!")
-    print("=== END DEBUG ===\n")
-
 # Function to get voice choices for dropdowns
 def get_voice_choices():
     updated_choices = update_voice_choices()
@@ -1151,6 +307,7 @@ def create_voice_assignment_interface(script_text):
     # Return: voice_assignment_interface update + 10 individual radio updates + detected_speakers
     return [gr.update(visible=True)] + radio_updates + [speakers]
 
+@show_engine_errors
 def generate_from_script_with_voices(script_text, pause_duration, default_speed, output_format, *voice_assignments):
     """Generate conversation from script with voice assignments"""
     conversation = parse_conversation_script(script_text)
@@ -2487,11 +1644,24 @@ with gr.Blocks(css="""
                                     )
                                 with gr.Row():
                                     output_format = gr.Radio(
-                                        choices=['WAV', 'MP3'],
+                                        choices=['WAV', 'MP3', 'FLAC', 'OPUS'],
                                         value='WAV',
                                         label='🎵 Output Format',
                                         info='Choose audio file format'
                                     )
+                                with gr.Row():
+                                    stream_output = gr.Checkbox(
+                                        value=False,
+                                        label='⚡ Stream While Generating',
+                                        info='Play each sentence as soon as it is ready'
+                                    )
+                                with gr.Row():
+                                    backend = gr.Radio(
+                                        choices=BACKENDS,
+                                        value=BACKEND,
+                                        label='🧮 Inference Backend',
+                                        info='int8 (quantized) and onnx (ONNX Runtime) run on the CPU; compiled uses torch.compile'
+                                    )
                         
                         with gr.Row():
                             refresh_btn = gr.Button('🔄 Refresh Voices To Show Custom Voices', size='sm')
@@ -2500,6 +1670,14 @@ with gr.Blocks(css="""
                     with gr.Column(elem_id="output-box", elem_classes=["card"]):
                         gr.Markdown("<h3 style='text-align: center; margin-top: 0; font-size: 1.2rem;'>🎧 Generated Audio</h3>")
                         
+                        stream_audio = gr.Audio(
+                            label='Live Preview', 
+                            interactive=False, 
+                            streaming=True, 
+                            autoplay=True,
+                            elem_id="stream-audio-output"
+                        )
+                        
                         out_audio = gr.Audio(
                             label=None, 
                             interactive=False, 
@@ -2722,7 +1900,7 @@ with gr.Blocks(css="""
                         voice_formula = gr.Textbox(
                             label="🔠 Voice Formula",
                             placeholder="Formula will be generated from sliders",
-                            info="This formula will be used to create the mixed voice",
+                            info="This formula will be used to create the mixed voice. It also works directly as a voice in the engine and CLI",
                             interactive=True
                         )
                     with gr.Column(scale=1):
@@ -2731,6 +1909,11 @@ with gr.Blocks(css="""
                             placeholder="Enter a name for your mixed voice (optional)",
                             info="Leave blank for auto-generated name"
                         )
+                        save_mixed_voice = gr.Checkbox(
+                            value=False,
+                            label="💾 Save as Custom Voice",
+                            info="Write the mix to custom_voices so it appears in the voice lists"
+                        )
                 
                 with gr.Row():
                     with gr.Column(scale=2):
@@ -2831,7 +2014,7 @@ with gr.Blocks(css="""
                         )
                         
                         batch_output_format = gr.Radio(
-                            choices=['WAV', 'MP3'],
+                            choices=['WAV', 'MP3', 'FLAC', 'OPUS'],
                             value='WAV',
                             label="Output Format (applies to all files)",
                             interactive=True
@@ -2968,7 +2151,7 @@ Speaker 2: That's wonderful to hear!""",
                                     )
                                 with gr.Column(scale=1):
                                     script_output_format = gr.Radio(
-                                        choices=['WAV', 'MP3'],
+                                        choices=['WAV', 'MP3', 'FLAC', 'OPUS'],
                                         value='WAV',
                                         label='🎵 Output Format',
                                         info='Choose audio file format'
@@ -3080,7 +2263,7 @@ Bob: That's wonderful to hear.""",
         )
 
     # Connect buttons to functions
-    generate_btn.click(fn=generate_first, inputs=[text, voice, speed, output_format], outputs=[out_audio, out_ps, large_file_info])
+    generate_btn.click(fn=generate_speech, inputs=[text, voice, speed, output_format, stream_output, backend], outputs=[stream_audio, out_audio, out_ps, large_file_info])
     
     # Connect file upload to voice assignment interface
     batch_files.change(
@@ -3097,6 +2280,7 @@ Bob: That's wonderful to hear.""",
     )
     
     # Connect batch conversion functionality
+    @show_engine_errors
     def handle_batch_conversion_with_voices(files, speed, output_format, *voice_assignments):
         summary, audio_files = batch_convert_text_files_with_voices(files, speed, output_format, *voice_assignments)
         audio_updates = update_batch_audio_players(audio_files)
@@ -3161,7 +2345,7 @@ Bob: That's wonderful to hear.""",
     # Connect the mix button to generate the mixed voice
     mix_btn.click(
         fn=generate_mixed_voice,
-        inputs=[voice_formula, mixed_voice_name, voice_text],
+        inputs=[voice_formula, mixed_voice_name, voice_text, save_mixed_voice],
         outputs=[mix_status, mix_audio]
     )
 
@@ -3190,4 +2374,8 @@ Bob: That's wonderful to hear.""",
     # Debug custom voices
     debug_custom_voices()
 
+# Allow concurrent handlers so the scheduler can batch their segments together. Their G2P
+# still runs one segment at a time per language, behind the lock in engine.phonemize
+app.queue(default_concurrency_limit=SCHEDULER_MAX_BATCH if SCHEDULER_ENABLED else 1)
 app.launch()
+
@@ -0,0 +1,214 @@
+"""Incremental audio file writers for long renders.
+
+WavWriter appends each segment's samples to an open WAV file as they are generated and
+fills in the header sizes when it is closed, so memory use does not grow with the length
+of the audio. Samples are stored as 16-bit PCM or as 32-bit float, the layout
+scipy.io.wavfile.write produces for float32 arrays. The model often peaks above full
+scale, so 16-bit samples pass through soft_limit() instead of being clipped. A reserved JUNK chunk lets a file
+that outgrows the 4 GB RIFF limit be upgraded to RF64 in place on close.
+
+FfmpegEncoder has the same interface but pipes the samples into an ffmpeg process, which
+encodes while synthesis continues and writes only the compressed file.
+"""
+import os
+import struct
+import subprocess
+import tempfile
+import numpy as np
+
+# RIFF sizes are 32-bit; beyond this the file is rewritten as RF64
+RIFF_LIMIT = 0xFFFFFFFF
+# RIFF header, JUNK, fmt, fact and data chunk headers
+HEADER_BYTES = 12 + 36 + 26 + 12 + 8
+# Bytes per sample and WAVE format tag of each sample format
+SAMPLE_FORMATS = {
+    'pcm16': (2, 1),
+    'float32': (4, 3),
+}
+# Level above which soft_limit() starts compressing peaks
+LIMIT_KNEE = 0.9
+
+def to_float32(audio):
+    """Flatten a tensor or array of samples into contiguous little-endian float32"""
+    if hasattr(audio, 'detach'):
+        audio = audio.detach().cpu().numpy()
+    return np.ascontiguousarray(audio, dtype='<f4').reshape(-1)
+
+def soft_limit(samples, knee=LIMIT_KNEE):
+    """Bend samples above knee smoothly towards full scale so integer formats do not clip.
+
+    Samples within ±knee are unchanged; beyond it the curve follows tanh, which has the same
+    slope at the knee and never reaches 1, so a peak of 1.5 lands just below full scale
+    instead of being flattened.
+    """
+    over = np.abs(samples) > knee
+    if not over.any():
+        return samples
+    samples = samples.copy()
+    headroom = 1 - knee
+    peaks = samples[over]
+    samples[over] = np.sign(peaks) * (knee + headroom * np.tanh((np.abs(peaks) - knee) / headroom))
+    return samples
+
+class WavWriter:
+    """Write mono audio to a WAV file one segment at a time.
+
+    Passing frames reopens a file written by an earlier WavWriter with the same sample
+    format and continues after its first `frames` samples, dropping anything past them.
+    """
+
+    def __init__(self, path, sample_rate=24000, frames=0, sample_format='float32'):
+        if sample_format not in SAMPLE_FORMATS:
+            raise ValueError(f"Unknown WAV sample format '{sample_format}'. Choose one of: {', '.join(SAMPLE_FORMATS)}")
+        self.path = path
+        self.sample_rate = sample_rate
+        self.frames = frames
+        self.sample_format = sample_format
+        self.sample_bytes, self.format_tag = SAMPLE_FORMATS[sample_format]
+        if frames:
+            self.file = open(path, 'r+b')
+            self.file.truncate(HEADER_BYTES + frames * self.sample_bytes)
+            self.file.seek(0, 2)
+        else:
+            self.file = open(path, 'wb')
+            self._write_header()
+
+    def _write_header(self):
+        f = self.file
+        data_bytes = self.frames * self.sample_bytes
+        f.write(b'RIFF')
+        f.write(struct.pack('<I', min(RIFF_LIMIT, HEADER_BYTES - 8 + data_bytes)))
+        f.write(b'WAVE')
+        # Placeholder for the ds64 chunk an RF64 file needs
+        f.write(b'JUNK')
+        f.write(struct.pack('<I', 28))
+        f.write(b'\0' * 28)
+        # Mono, no format extension
+        f.write(b'fmt ')
+        f.write(struct.pack('<IHHIIHHH', 18, self.format_tag, 1, self.sample_rate, self.sample_rate * self.sample_bytes,
+                            self.sample_bytes, self.sample_bytes * 8, 0))
+        f.write(b'fact')
+        f.write(struct.pack('<II', 4, min(RIFF_LIMIT, self.frames)))
+        f.write(b'data')
+        f.write(struct.pack('<I', min(RIFF_LIMIT, data_bytes)))
+
+    def write(self, audio):
+        """Append a segment (1-D tensor or array of samples)"""
+        samples = to_float32(audio)
+        if self.sample_format == 'pcm16':
+            samples = np.round(soft_limit(samples) * 32767).astype('<i2')
+        self.file.write(samples.tobytes())
+        self.frames += len(samples)
+
+    def flush(self, sync=False):
+        """Push written samples to the OS, and to disk as well when sync is set"""
+        self.file.flush()
+        if sync:
+            os.fsync(self.file.fileno())
+
+    @property
+    def seconds(self):
+        return self.frames / self.sample_rate
+
+    def close(self):
+        """Patch the header with the final sizes and close the file"""
+        if self.file.closed:
+            return
+        data_bytes = self.frames * self.sample_bytes
+        riff_bytes = self.file.tell() - 8
+        self.file.seek(0)
+        self._write_header()
+        if riff_bytes > RIFF_LIMIT:
+            # Too large for RIFF: turn the reserved JUNK chunk into ds64 with 64-bit sizes
+            self.file.seek(0)
+            self.file.write(b'RF64')
+            self.file.seek(12)
+            self.file.write(b'ds64')
+            self.file.write(struct.pack('<IQQQI', 28, riff_bytes, data_bytes, self.frames, 0))
+        self.file.close()
+
+    def abort(self):
+        """Close and delete an unfinished file"""
+        self.file.close()
+        os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class FfmpegEncoder:
+    """Encode mono float32 audio with ffmpeg as it is written, like WavWriter but compressed.
+
+    Set limit when codec_args produce integer samples (FLAC, 16-bit PCM), so peaks above
+    full scale pass through soft_limit() rather than being clipped by ffmpeg.
+    """
+
+    def __init__(self, path, sample_rate, ffmpeg_path, codec_args, limit=False):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.limit = limit
+        self.frames = 0
+        # A file rather than a pipe, so a chatty ffmpeg can never block on its stderr
+        self.stderr = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(
+            [ffmpeg_path, '-hide_banner', '-loglevel', 'error',
+             '-f', 'f32le', '-ar', str(sample_rate), '-ac', '1', '-i', 'pipe:0',
+             *codec_args, '-y', path],
+            stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=self.stderr,
+        )
+
+    def _error(self):
+        self.stderr.seek(0)
+        message = self.stderr.read().decode('utf-8', errors='replace').strip()
+        return OSError(f"ffmpeg exited with code {self.process.returncode}: {message}")
+
+    def write(self, audio):
+        """Send a segment (1-D tensor or array of samples) to the encoder"""
+        samples = to_float32(audio)
+        if self.limit:
+            samples = soft_limit(samples)
+        try:
+            self.process.stdin.write(samples.tobytes())
+        except BrokenPipeError:
+            self.process.wait()
+            raise self._error()
+        self.frames += len(samples)
+
+    def flush(self, sync=False):
+        self.process.stdin.flush()
+
+    @property
+    def seconds(self):
+        return self.frames / self.sample_rate
+
+    def close(self):
+        """Finish encoding, raising OSError if ffmpeg failed"""
+        if self.process.stdin.closed:
+            return
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        if self.process.wait() != 0:
+            raise self._error()
+        self.stderr.close()
+
+    def abort(self):
+        """Stop ffmpeg and delete the partial file"""
+        self.process.kill()
+        self.process.wait()
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.stderr.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
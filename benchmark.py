@@ -0,0 +1,162 @@
+"""Benchmark the inference backends against the fp32 model.
+
+Every backend synthesizes the same fixed corpus one segment at a time. For each
+backend this reports speed:
+    startup   - seconds until the first segment is done, including building the backend
+    RTF       - synthesis time divided by audio length (lower is faster)
+    p50/p95   - per-segment latency in milliseconds
+    seg/s     - segments synthesized per second
+and how far its audio drifts from fp32:
+    duration  - change in total audio length
+    LSD       - log-spectral distance in dB over the overlapping part of each segment
+    SNR       - signal-to-noise ratio in dB, for segments whose length did not change
+
+The vocoder draws random phase and noise for every segment. For the quality comparison
+each segment is synthesized after torch.manual_seed with the same per-segment seed on
+every backend, so eager torch backends (fp32, int8) draw identical noise and only the
+backend differs. The ONNX graph (and a torch.compile graph, which generates its own
+random numbers) cannot be seeded that way, so those rows also contain vocoder noise.
+The "fp32 noise" row measures exactly that: fp32 with different seeds, against the same
+reference and in the same units. A backend matches fp32 when its LSD and SNR are about
+as good as that row's.
+Examples:
+    python benchmark.py
+    python benchmark.py --backends fp32 int8 onnx compiled --voice bf_emma --runs 5
+    python benchmark.py --file chapter1.txt
+
+The onnx backend needs the optional onnx and onnxruntime packages
+(pip install onnx onnxruntime); a backend that cannot be built is skipped with its error.
+"""
+import argparse
+import time
+import torch
+
+SAMPLE_RATE = 24000
+
+DEFAULT_TEXT = (
+    "Kokoro is an open-weight text to speech model with eighty two million parameters. "
+    "Despite its lightweight architecture, it delivers comparable quality to larger models "
+    "while being significantly faster and more cost-efficient. "
+    "With Apache-licensed weights, it can be deployed anywhere from production environments "
+    "to personal projects. "
+    "The quick brown fox jumps over the lazy dog. "
+    "How much wood would a woodchuck chuck, if a woodchuck could chuck wood? "
+    "On the twelfth of March, nineteen ninety-five, the temperature reached thirty-one degrees."
+)
+
+def log_spectral_distance(reference, audio, n_fft=1024, hop_length=256):
+    """Mean log-spectral distance in dB between two signals over their common length"""
+    length = min(reference.shape[-1], audio.shape[-1])
+    window = torch.hann_window(n_fft)
+    spectra = []
+    for signal in (reference[:length], audio[:length]):
+        spectrum = torch.stft(signal, n_fft, hop_length, window=window, return_complex=True)
+        spectra.append(10 * torch.log10(spectrum.abs().pow(2) + 1e-10))
+    return (spectra[0] - spectra[1]).pow(2).mean(dim=0).sqrt().mean().item()
+
+def snr(reference, audio):
+    """Signal-to-noise ratio in dB of audio against reference, or None if the lengths differ"""
+    if reference.shape != audio.shape:
+        return None
+    noise = (reference - audio).pow(2).sum()
+    if noise == 0:
+        return float('inf')
+    return (10 * torch.log10(reference.pow(2).sum() / noise)).item()
+
+def synthesize(engine, segments, pack, speed, backend, latencies=None, seed=None):
+    """Synthesize each segment, seeding the RNG with seed + index first when seed is given.
+
+    The backend's model is called directly rather than through engine.forward(), whose
+    fallback to fp32 would otherwise be measured under the backend's name.
+    """
+    model = engine.device_manager.model(backend)
+    audio = []
+    for i, ps in enumerate(segments):
+        if seed is not None:
+            torch.manual_seed(seed + i)
+        start_time = time.perf_counter()
+        audio.append(model(ps, pack[len(ps)-1], speed).cpu())
+        if latencies is not None:
+            latencies.append(time.perf_counter() - start_time)
+    return audio
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark Kokoro inference backends against fp32")
+    parser.add_argument('--text', default=DEFAULT_TEXT, help="Text to synthesize")
+    parser.add_argument('-f', '--file', help="Read the text from a file instead")
+    parser.add_argument('-v', '--voice', default='af_heart', help="Voice id (default: af_heart)")
+    parser.add_argument('-s', '--speed', type=float, default=1.0, help="Speech speed (default: 1.0)")
+    parser.add_argument('--backends', nargs='+', default=['fp32', 'int8', 'onnx'], help="Backends to compare (default: fp32 int8 onnx)")
+    parser.add_argument('--runs', type=int, default=3, help="Timed runs per backend (default: 3)")
+    args = parser.parse_args(argv)
+
+    text = args.text
+    if args.file:
+        with open(args.file, 'r', encoding='utf-8') as f:
+            text = f.read()
+
+    # Imported here so --help does not pay for loading the model
+    import engine
+
+    voice, lang_code, pack = engine.resolve_voice(args.voice)
+    backends = [engine.resolve_backend(backend) for backend in args.backends]
+    if 'fp32' not in backends:
+        backends.insert(0, 'fp32')
+    segments = [ps for _, ps in engine.phonemize(lang_code, text.strip())]
+    print(f"Benchmarking {len(segments)} segments with voice {voice} on {torch.get_num_threads()} CPU threads")
+
+    results = {}
+    for backend in backends:
+        # Build the backend's model, then warm up to fill any lazy caches
+        start_time = time.perf_counter()
+        try:
+            engine.device_manager.model(backend)
+        except RuntimeError as e:
+            print(f"Skipping {backend}: {e}")
+            continue
+        synthesize(engine, segments[:1], pack, args.speed, backend)
+        startup = time.perf_counter() - start_time
+        timings = []
+        latencies = []
+        for _ in range(args.runs):
+            start_time = time.perf_counter()
+            audio = synthesize(engine, segments, pack, args.speed, backend, latencies)
+            timings.append(time.perf_counter() - start_time)
+        audio = synthesize(engine, segments, pack, args.speed, backend, seed=0)
+        audio_seconds = sum(a.shape[-1] for a in audio) / SAMPLE_RATE
+        results[backend] = {
+            'audio': audio,
+            'seconds': audio_seconds,
+            'startup': startup,
+            'rtf': min(timings) / audio_seconds,
+            'p50': engine.percentile(latencies, 50) * 1000,
+            'p95': engine.percentile(latencies, 95) * 1000,
+            'throughput': len(segments) / min(timings),
+        }
+
+    # fp32 again with seeds the reference did not use: the difference vocoder noise alone makes
+    noise_floor = synthesize(engine, segments, pack, args.speed, 'fp32', seed=len(segments))
+
+    reference = results['fp32']
+    def quality(audio):
+        seconds = sum(a.shape[-1] for a in audio) / SAMPLE_RATE
+        duration = (seconds - reference['seconds']) / reference['seconds'] * 100
+        lsd = sum(log_spectral_distance(r, a) for r, a in zip(reference['audio'], audio)) / len(audio)
+        snrs = [value for value in (snr(r, a) for r, a in zip(reference['audio'], audio)) if value is not None]
+        snr_text = f"{min(snrs):.1f}" if snrs else "n/a"
+        return f"{duration:>+9.1f}%{lsd:>9.2f}{snr_text:>9}"
+
+    print(f"\n{'backend':<11}{'startup s':>10}{'RTF':>8}{'speedup':>9}{'p50 ms':>9}{'p95 ms':>9}{'seg/s':>8}{'duration':>10}{'LSD dB':>9}{'SNR dB':>9}")
+    for backend, result in results.items():
+        speedup = reference['rtf'] / result['rtf']
+        print(f"{backend:<11}{result['startup']:>10.1f}{result['rtf']:>8.3f}{speedup:>8.2f}x{result['p50']:>9.0f}{result['p95']:>9.0f}"
+              f"{result['throughput']:>8.2f}{quality(result['audio'])}")
+    print(f"{'fp32 noise':<11}{'':>53}{quality(noise_floor)}")
+
+    print("\nAudio is compared with fp32 using the same per-segment seeds. onnx and compiled cannot follow")
+    print("the seeds; read their LSD and SNR against the fp32 noise row, which differs only in its seeds.")
+    print("SNR is the worst segment whose length matched fp32; n/a means every segment's duration changed.")
+    return 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,101 @@
+"""Command-line interface for rendering speech without starting the Gradio UI.
+
+Examples:
+    python cli.py "Hello world" --voice af_heart
+    python cli.py --file chapter1.txt --file chapter2.txt --format MP3 --output renders/
+    python cli.py --file book.txt --resume
+    echo "Hello" | python cli.py - --output hello.wav
+    python cli.py --list-voices
+    python cli.py --export-onnx
+    python cli.py --build-voice-bank
+    python cli.py --prune-outputs
+"""
+import argparse
+import os
+import shutil
+import sys
+
+def output_path(output, name, audio_filepath, multiple):
+    """Work out where a rendered file should go, or None to leave it in the outputs folder"""
+    if not output:
+        return None
+    extension = os.path.splitext(audio_filepath)[1]
+    if multiple or os.path.isdir(output) or output.endswith(os.sep):
+        os.makedirs(output, exist_ok=True)
+        return os.path.join(output, f"{name}{extension}")
+    parent = os.path.dirname(os.path.abspath(output))
+    os.makedirs(parent, exist_ok=True)
+    return output
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render text to speech with Kokoro TTS")
+    parser.add_argument('text', nargs='?', help="Text to speak, or '-' to read it from stdin")
+    parser.add_argument('-f', '--file', action='append', default=[], help="Text file to render (can be repeated)")
+    parser.add_argument('-v', '--voice', default='af_heart', help="Voice id such as af_heart or custom_<name> (default: af_heart)")
+    parser.add_argument('-s', '--speed', type=float, default=1.0, help="Speech speed from 0.5 to 4 (default: 1.0)")
+    parser.add_argument('--format', type=str.upper, default='WAV', choices=['WAV', 'MP3', 'FLAC', 'OPUS'], help="Output format (default: WAV)")
+    parser.add_argument('--backend', type=str.lower, choices=['fp32', 'int8', 'onnx', 'compiled'], help="Inference backend (default: KOKORO_BACKEND or fp32)")
+    parser.add_argument('--export-onnx', action='store_true', help="Export the model for the onnx backend and exit")
+    parser.add_argument('--resume', action='store_true', help="Checkpoint each finished segment so an interrupted render resumes when rerun")
+    parser.add_argument('-o', '--output', help="Output file for a single input, or a directory")
+    parser.add_argument('--build-voice-bank', action='store_true', help="Pack every voice into the memory-mapped voice bank and exit")
+    parser.add_argument('--list-voices', action='store_true', help="List the available voices and exit")
+    parser.add_argument('--prune-outputs', action='store_true', help="Index the outputs folder, apply the retention limits and exit")
+    args = parser.parse_args(argv)
+
+    if not args.list_voices and not args.export_onnx and not args.build_voice_bank and not args.prune_outputs and not args.text and not args.file:
+        parser.error("provide text, '-' for stdin, or --file")
+
+    # Imported here so --help does not pay for loading the model
+    import engine
+
+    if args.export_onnx:
+        print(engine.export_onnx())
+        return 0
+
+    if args.build_voice_bank:
+        print(engine.build_voice_bank())
+        return 0
+
+    if args.prune_outputs:
+        engine.output_store.scan()
+        engine.debug_output_store_stats()
+        return 0
+
+    if args.list_voices:
+        for display_name, voice_id in engine.update_voice_choices().items():
+            print(f"{voice_id:24} {display_name}")
+        return 0
+
+    jobs = []
+    if args.text:
+        text = sys.stdin.read() if args.text == '-' else args.text
+        jobs.append(('speech', text))
+    for file_path in args.file:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            jobs.append((os.path.splitext(os.path.basename(file_path))[0], f.read()))
+
+    failed = 0
+    for name, text in jobs:
+        if not text.strip():
+            print(f"Skipping empty input: {name}", file=sys.stderr)
+            failed += 1
+            continue
+        try:
+            audio_filepath, _, _ = engine.generate_first(text, args.voice, args.speed, args.format, args.backend, job=args.resume)
+        except engine.EngineError as e:
+            print(f"Error rendering {name}: {e}", file=sys.stderr)
+            failed += 1
+            continue
+        destination = output_path(args.output, name, audio_filepath, multiple=len(jobs) > 1)
+        if destination:
+            # Files moved out of the outputs folder are no longer managed by the output store
+            engine.output_store.release(audio_filepath)
+            shutil.move(audio_filepath, destination)
+            audio_filepath = destination
+        print(audio_filepath)
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
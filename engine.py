@@ -0,0 +1,2747 @@
+"""Headless Kokoro synthesis engine.
+
+Model, pipeline and voice management plus the generation functions used by the
+Gradio app (app.py) and the command-line interface (cli.py). Importing this module
+does not import Gradio.
+"""
+import os
+import torch
+from datetime import datetime
+from kokoro import KModel, KPipeline
+from tqdm import tqdm
+import subprocess
+import warnings
+import threading
+import queue
+import time
+import json
+import sqlite3
+import unicodedata
+import re
+import math
+import shutil
+import itertools
+import hashlib
+import atexit
+import numpy as np
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from voice_bank import VoiceBank
+from audio_writer import WavWriter, FfmpegEncoder, HEADER_BYTES, SAMPLE_FORMATS
+
+class EngineError(Exception):
+    """Raised for requests the engine cannot serve, such as an unknown voice or empty input"""
+
+# Set explicit cache directories to ensure consistent caching
+cache_base = os.path.abspath(os.path.join(os.getcwd(), 'cache'))
+os.environ["HF_HOME"] = os.path.abspath(os.path.join(cache_base, 'HF_HOME'))
+os.environ["TORCH_HOME"] = os.path.abspath(os.path.join(cache_base, 'TORCH_HOME'))
+os.environ["TRANSFORMERS_CACHE"] = os.environ["HF_HOME"]
+os.environ["HF_DATASETS_CACHE"] = os.environ["HF_HOME"]
+os.environ["HF_HUB_DISABLE_SYMLINKS_WARNING"] = "1"
+
+# Generated audio is written to the outputs folder
+output_folder = os.path.join(os.getcwd(), 'outputs')
+# Add these environment variables to prevent redownloading models each time
+os.environ["TRANSFORMERS_OFFLINE"] = "1"
+os.environ["HF_HUB_OFFLINE"] = "1"
+
+print(f"Using cache directory: {os.environ['HF_HOME']}")
+
+torch.nn.utils.parametrize = torch.nn.utils.parametrizations.weight_norm
+warnings.filterwarnings("ignore", category=UserWarning, module="torch.nn.modules.rnn")
+warnings.filterwarnings("ignore", category=FutureWarning, module="torch.nn.utils.weight_norm")
+
+# Device selection: "auto" uses the GPU when one is present and keeps a CPU model as
+# a fallback, "cpu" never touches CUDA. Thread counts of 0 keep torch's defaults
+DEVICE = os.environ.get('KOKORO_DEVICE', 'auto').lower()
+CPU_THREADS = int(os.environ.get('KOKORO_CPU_THREADS', '0'))
+CPU_INTEROP_THREADS = int(os.environ.get('KOKORO_CPU_INTEROP_THREADS', '0'))
+
+# Inference backends. "fp32" runs the model as loaded; "int8" applies dynamic int8
+# quantization to the Linear and LSTM layers and always runs on the CPU; "onnx" runs an
+# exported graph with ONNX Runtime on the CPU; "compiled" runs the model through
+# torch.compile. KOKORO_BACKEND sets the default, and requests can pick another one
+BACKENDS = ['fp32', 'int8', 'onnx', 'compiled']
+BACKEND = os.environ.get('KOKORO_BACKEND', 'fp32').lower()
+if BACKEND not in BACKENDS:
+    print(f"Warning: Unknown KOKORO_BACKEND '{BACKEND}'. Choose one of: {', '.join(BACKENDS)}. Using fp32.")
+    BACKEND = 'fp32'
+
+# ONNX backend settings. The model is exported to ONNX_MODEL_PATH the first time the
+# backend is used; ONNX_THREADS of 0 uses KOKORO_CPU_THREADS, or ONNX Runtime's default
+ONNX_MODEL_PATH = os.environ.get('KOKORO_ONNX_PATH', os.path.join(cache_base, 'onnx', 'kokoro-v1_0.onnx'))
+ONNX_THREADS = int(os.environ.get('KOKORO_ONNX_THREADS', '0')) or CPU_THREADS
+ONNX_OPT_LEVEL = os.environ.get('KOKORO_ONNX_OPT_LEVEL', 'all').lower()
+
+# Compiled backend settings: the torch.compile mode, and the phoneme lengths run once
+# when the backend is built so compilation is paid before the first request
+COMPILE_MODE = os.environ.get('KOKORO_COMPILE_MODE', 'default')
+COMPILE_WARMUP_LENGTHS = [int(n) for n in os.environ.get('KOKORO_COMPILE_WARMUP', '16,64,256').split(',') if n.strip()]
+
+class DeviceManager:
+    """Holds one KModel per usable device and routes inference to the preferred one.
+
+    A CPU model is always loaded so there is somewhere to fall back to; a GPU model is
+    added only when CUDA is available and not disabled through KOKORO_DEVICE.
+    """
+
+    def __init__(self, device='auto', cpu_threads=0, interop_threads=0):
+        self.use_gpu = device != 'cpu' and torch.cuda.is_available()
+        if device == 'cuda' and not self.use_gpu:
+            print("KOKORO_DEVICE=cuda but no GPU is available, using the CPU.")
+        self.configure_threads(cpu_threads, interop_threads)
+        self.models = {}
+        self.variants = {}
+        self.unavailable = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def configure_threads(cpu_threads, interop_threads):
+        if cpu_threads > 0:
+            torch.set_num_threads(cpu_threads)
+        if interop_threads > 0:
+            try:
+                torch.set_num_interop_threads(interop_threads)
+            except RuntimeError as e:
+                # Only allowed before torch starts any inter-op work
+                print(f"Warning: Could not set inter-op threads: {str(e)}")
+        print(f"CPU threads: intra-op {torch.get_num_threads()}, inter-op {torch.get_num_interop_threads()}")
+
+    def load(self):
+        """Load the CPU model and, if a GPU is in use, a second copy on the GPU"""
+        models = {False: KModel(repo_id="hexgrad/Kokoro-82M").to('cpu').eval()}
+        if self.use_gpu:
+            try:
+                models[True] = KModel(repo_id="hexgrad/Kokoro-82M").to('cuda').eval()
+            except Exception as e:
+                print(f"Error loading model to GPU: {str(e)}. Using the CPU only.")
+                self.use_gpu = False
+        self.models = models
+        print("Model loaded to GPU." if self.use_gpu else "Model loaded to CPU.")
+
+    @staticmethod
+    def quantize(model):
+        """Apply dynamic int8 quantization to a CPU model's Linear and LSTM layers in place"""
+        torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear, torch.nn.LSTM}, dtype=torch.qint8, inplace=True)
+        for module in model.modules():
+            if isinstance(module, torch.ao.nn.quantized.dynamic.LSTM):
+                # Kokoro calls flatten_parameters() before every LSTM; quantized LSTMs lack it
+                module.flatten_parameters = lambda: None
+        return model
+
+    def build_onnx(self, path=ONNX_MODEL_PATH):
+        """Load the ONNX Runtime model, exporting it first if the file does not exist yet"""
+        import onnx_backend
+        if not os.path.exists(path):
+            export_onnx(path)
+        return onnx_backend.OnnxModel(path, self.models[False].vocab, ONNX_THREADS, ONNX_OPT_LEVEL)
+
+    def build_compiled(self):
+        """Compile a separate KModel copy and warm it up over COMPILE_WARMUP_LENGTHS"""
+        model = KModel(repo_id="hexgrad/Kokoro-82M").to('cuda' if self.use_gpu else 'cpu').eval()
+        # KModel.forward and forward_batch call the same submodules, so both paths are compiled
+        for module in (model.bert, model.text_encoder, model.decoder):
+            module.compile(dynamic=True, mode=COMPILE_MODE)
+        # torch.compile is lazy; any compilation error surfaces in these calls
+        symbols = [symbol for symbol in model.vocab if symbol.isalpha()]
+        # Style vectors are views into a (510, 1, 256) voice pack; dynamo guards on the
+        # view layout, so warm up with the same kind of tensor real requests pass
+        pack = torch.zeros(510, 1, 256)
+        for length in COMPILE_WARMUP_LENGTHS:
+            # KModel accepts at most 510 phonemes per segment
+            ps = ''.join(symbols[i % len(symbols)] for i in range(min(length, 510)))
+            ref_s = pack[len(ps)-1]
+            start_time = time.perf_counter()
+            model(ps, ref_s, 1)
+            first_call = time.perf_counter() - start_time
+            start_time = time.perf_counter()
+            model(ps, ref_s, 1)
+            steady = time.perf_counter() - start_time
+            print(f"  Warm-up {len(ps)} phonemes: first call {first_call:.1f}s, steady state {steady * 1000:.0f} ms")
+        if len(COMPILE_WARMUP_LENGTHS) > 1:
+            # Batches of more than one segment compile separate graphs
+            start_time = time.perf_counter()
+            short = ps[:COMPILE_WARMUP_LENGTHS[0]]
+            forward_batch(model, [short, ps], [pack[len(short)-1], ref_s], 1)
+            print(f"  Warm-up batched call: {time.perf_counter() - start_time:.1f}s")
+        return model
+
+    def variant(self, backend):
+        """Return the model for a non-fp32 backend, building it on first use"""
+        model = self.variants.get(backend)
+        if model is not None:
+            return model
+        with self.lock:
+            if backend in self.unavailable:
+                raise RuntimeError(self.unavailable[backend])
+            if backend not in self.variants:
+                print(f"Building {backend} model...")
+                start_time = time.perf_counter()
+                try:
+                    if backend == 'int8':
+                        # KModel cannot be deep-copied (weight_norm), so load a separate copy to convert
+                        model = self.quantize(KModel(repo_id="hexgrad/Kokoro-82M").to('cpu').eval())
+                    elif backend == 'onnx':
+                        model = self.build_onnx()
+                    elif backend == 'compiled':
+                        model = self.build_compiled()
+                    else:
+                        raise ValueError(f"Unknown backend: {backend}")
+                except Exception as e:
+                    # Remember the failure so every segment does not retry the build
+                    self.unavailable[backend] = f"{backend} backend unavailable: {str(e)}"
+                    raise RuntimeError(self.unavailable[backend]) from e
+                self.variants[backend] = model
+                print(f"{backend} model ready in {time.perf_counter() - start_time:.1f} seconds")
+            return self.variants[backend]
+
+    def model(self, backend='fp32'):
+        """Return the model that runs inference for backend"""
+        if backend != 'fp32':
+            return self.variant(backend)
+        return self.models[True] if self.use_gpu else self.models[False]
+
+    def forward(self, ps, ref_s, speed, backend='fp32'):
+        if backend != 'fp32':
+            try:
+                return self.variant(backend)(ps, ref_s, speed)
+            except Exception as e:
+                print(f"Error with {backend} backend: {e}. Falling back to fp32.")
+        if not self.use_gpu:
+            return self.models[False](ps, ref_s, speed)
+        try:
+            return self.models[True](ps, ref_s, speed)
+        except Exception as e:
+            print(f"Error with GPU processing: {e}. Falling back to CPU.")
+            return self.models[False](ps, ref_s, speed)
+
+device_manager = DeviceManager(DEVICE, CPU_THREADS, CPU_INTEROP_THREADS)
+
+try:
+    # First run - download models if they don't exist
+    if not os.path.exists(os.path.join(cache_base, 'HF_HOME/hub/models--hexgrad--Kokoro-82M')):
+        print("First run detected, downloading models...")
+        # Temporarily disable offline mode to allow downloads
+        os.environ.pop("TRANSFORMERS_OFFLINE", None)
+        os.environ.pop("HF_HUB_OFFLINE", None)
+        
+    # Load models with environment variables controlling cache location
+    device_manager.load()
+
+    # After successful loading, re-enable offline mode to prevent future download attempts
+    os.environ["TRANSFORMERS_OFFLINE"] = "1"
+    os.environ["HF_HUB_OFFLINE"] = "1"
+    
+except Exception as e:
+    print(f"Error during model loading: {str(e)}")
+    print("Attempting to load in online mode...")
+    # If offline loading fails, try online mode
+    os.environ.pop("TRANSFORMERS_OFFLINE", None)
+    os.environ.pop("HF_HUB_OFFLINE", None)
+    
+    # Load models with environment variables controlling cache location
+    device_manager.load()
+
+def resolve_backend(backend=None):
+    """Return backend, or the configured default when it is None"""
+    backend = (backend or BACKEND).lower()
+    if backend not in BACKENDS:
+        raise EngineError(f"Unknown backend '{backend}'. Choose one of: {', '.join(BACKENDS)}")
+    return backend
+
+def export_onnx(path=ONNX_MODEL_PATH):
+    """Export the model to ONNX for the onnx backend, replacing any existing file"""
+    import onnx_backend
+    # The vocoder's complex STFT cannot be exported; kokoro has a real-valued one
+    model = KModel(repo_id="hexgrad/Kokoro-82M", disable_complex=True).eval()
+    return onnx_backend.export_onnx(model, path)
+
+if BACKEND != 'fp32':
+    # Build and warm up the default backend now rather than on the first request. If it
+    # cannot be built the app still starts, with fp32 as the default
+    try:
+        device_manager.variant(BACKEND)
+    except Exception as e:
+        print(f"Warning: {str(e)}. Using fp32 as the default backend.")
+        BACKEND = 'fp32'
+
+def percentile(values, q):
+    """Nearest-rank q-th percentile of values, or 0.0 when there are none"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[max(0, -(-q * len(values) // 100) - 1)]
+
+# Voice packs stay resident in an LRU working set bounded by KOKORO_VOICE_MEMORY_MB;
+# anything evicted is loaded again on demand
+VOICE_MEMORY_MB = float(os.environ.get('KOKORO_VOICE_MEMORY_MB', 256))
+
+class VoiceStore:
+    """Least-recently-used set of resident voice packs with a memory budget"""
+
+    def __init__(self, memory_mb=VOICE_MEMORY_MB):
+        self.memory_limit = int(memory_mb * 1024 * 1024)
+        self.lock = threading.Lock()
+        self.packs = OrderedDict()
+        self.memory_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_times = deque(maxlen=1000)
+
+    @staticmethod
+    def _size(pack):
+        if isinstance(pack, (list, tuple)):
+            return sum(t.numel() * t.element_size() for t in pack)
+        return pack.numel() * pack.element_size()
+
+    def get(self, voice, count=True):
+        with self.lock:
+            pack = self.packs.get(voice)
+            if pack is None:
+                self.misses += count
+                return None
+            self.packs.move_to_end(voice)
+            self.hits += count
+            return pack
+
+    def put(self, voice, pack, load_seconds=None):
+        with self.lock:
+            if voice in self.packs:
+                self.memory_bytes -= self._size(self.packs.pop(voice))
+            self.packs[voice] = pack
+            self.memory_bytes += self._size(pack)
+            if load_seconds is not None:
+                self.load_times.append(load_seconds)
+            # Requests hold their own reference, so evicting a pack in use is safe
+            while self.memory_bytes > self.memory_limit and len(self.packs) > 1:
+                _, old_pack = self.packs.popitem(last=False)
+                self.memory_bytes -= self._size(old_pack)
+                self.evictions += 1
+
+    def discard(self, voice):
+        with self.lock:
+            if voice in self.packs:
+                self.memory_bytes -= self._size(self.packs.pop(voice))
+
+    def __contains__(self, voice):
+        return voice in self.packs
+
+    def __len__(self):
+        return len(self.packs)
+
+    def resident(self):
+        """Voice ids currently resident, least recently used first"""
+        with self.lock:
+            return list(self.packs)
+
+    def stats(self):
+        with self.lock:
+            load_times = list(self.load_times)
+            lookups = self.hits + self.misses
+            return {
+                'resident': len(self.packs),
+                'resident_mb': self.memory_bytes / (1024 * 1024),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'loads': len(load_times),
+                'load_ms_mean': sum(load_times) / len(load_times) * 1000 if load_times else 0.0,
+                'load_ms_p95': percentile(load_times, 95) * 1000,
+            }
+
+voice_store = VoiceStore()
+
+# Language pipelines and voice packs are created on first use. List language codes in
+# KOKORO_WARM_LANGS (e.g. "ab") to load those pipelines and voices at startup instead
+WARM_LANGS = os.environ.get('KOKORO_WARM_LANGS', '')
+pipelines = {}
+
+# Custom pronunciation of "kokoro" for pipelines whose g2p has a lexicon
+PIPELINE_GOLDS = {'a': 'kˈOkəɹO', 'b': 'kˈQkəɹQ', 'i': 'kˈkɔro'}
+
+_init_locks = {}
+_init_locks_guard = threading.Lock()
+
+def _once_lock(key):
+    """Return the lock guarding one-time initialization of key"""
+    with _init_locks_guard:
+        return _init_locks.setdefault(key, threading.Lock())
+
+def _load_with_online_fallback(loader):
+    """Run loader, retrying once in online mode in case files have not been downloaded yet"""
+    try:
+        return loader()
+    except Exception as e:
+        print(f"Error during loading: {str(e)}")
+        print("Attempting to load in online mode...")
+        os.environ.pop("TRANSFORMERS_OFFLINE", None)
+        os.environ.pop("HF_HUB_OFFLINE", None)
+        try:
+            return loader()
+        finally:
+            os.environ["TRANSFORMERS_OFFLINE"] = "1"
+            os.environ["HF_HUB_OFFLINE"] = "1"
+
+def get_pipeline(lang_code):
+    """Return the KPipeline for a language, creating it on first use"""
+    pipeline = pipelines.get(lang_code)
+    if pipeline is not None:
+        return pipeline
+    with _once_lock(('pipeline', lang_code)):
+        if lang_code not in pipelines:
+            print(f"Loading pipeline for language '{lang_code}'...")
+            start_time = time.perf_counter()
+            pipeline = _load_with_online_fallback(
+                lambda: KPipeline(repo_id="hexgrad/Kokoro-82M", lang_code=lang_code, model=False)
+            )
+            if lang_code in PIPELINE_GOLDS:
+                # Some pipelines (e.g. Italian) might not have a lexicon attribute
+                try:
+                    if hasattr(pipeline.g2p, 'lexicon'):
+                        pipeline.g2p.lexicon.golds['kokoro'] = PIPELINE_GOLDS[lang_code]
+                    else:
+                        print(f"Warning: Pipeline '{lang_code}' g2p doesn't have lexicon attribute, skipping custom pronunciation")
+                except Exception as e:
+                    print(f"Warning: Could not set custom pronunciation for '{lang_code}': {str(e)}")
+            pipelines[lang_code] = pipeline
+            print(f"Pipeline '{lang_code}' loaded in {time.perf_counter() - start_time:.1f} seconds")
+    return pipelines[lang_code]
+
+# Target size of a text segment in estimated phonemes. Text is split at sentence and
+# clause boundaries into segments of about this cost before phonemization
+SEGMENT_CHARS = int(os.environ.get('KOKORO_SEGMENT_CHARS', 250))
+# Hard cap on a segment's estimated phonemes, whatever the target
+SEGMENT_LIMIT = 400
+
+custom_voices_folder = os.path.join(os.getcwd(), 'custom_voices')
+
+# Create output folder if it doesn't exist (already defined above for GRADIO_TEMP_DIR)
+if not os.path.exists(output_folder):
+    os.makedirs(output_folder)
+
+if not os.path.exists(custom_voices_folder):
+    os.makedirs(custom_voices_folder)
+
+CHOICES = {
+    '🇺🇸 🚺 Heart ❤️': 'af_heart',
+    '🇺🇸 🚺 Bella 🔥': 'af_bella',
+    '🇺🇸 🚺 Nicole 🎧': 'af_nicole',
+    '🇺🇸 🚺 Aoede': 'af_aoede',
+    '🇺🇸 🚺 Kore': 'af_kore',
+    '🇺🇸 🚺 Sarah': 'af_sarah',
+    '🇺🇸 🚺 Nova': 'af_nova',
+    '🇺🇸 🚺 Sky': 'af_sky',
+    '🇺🇸 🚺 Alloy': 'af_alloy',
+    '🇺🇸 🚺 Jessica': 'af_jessica',
+    '🇺🇸 🚺 River': 'af_river',
+    '🇺🇸 🚹 Michael': 'am_michael',
+    '🇺🇸 🚹 Fenrir': 'am_fenrir',
+    '🇺🇸 🚹 Puck': 'am_puck',
+    '🇺🇸 🚹 Echo': 'am_echo',
+    '🇺🇸 🚹 Eric': 'am_eric',
+    '🇺🇸 🚹 Liam': 'am_liam',
+    '🇺🇸 🚹 Onyx': 'am_onyx',
+    '🇺🇸 🚹 Santa': 'am_santa',
+    '🇺🇸 🚹 Adam': 'am_adam',
+    '🇬🇧 🚺 Emma': 'bf_emma',
+    '🇬🇧 🚺 Isabella': 'bf_isabella',
+    '🇬🇧 🚺 Alice': 'bf_alice',
+    '🇬🇧 🚺 Lily': 'bf_lily',
+    '🇬🇧 🚹 George': 'bm_george',
+    '🇬🇧 🚹 Fable': 'bm_fable',
+    '🇬🇧 🚹 Lewis': 'bm_lewis',
+    '🇬🇧 🚹 Daniel': 'bm_daniel',
+    'PF 🚺 Dora': 'pf_dora',
+    'PM 🚹 Alex': 'pm_alex',
+    'PM 🚹 Santa': 'pm_santa',
+    '🇮🇹 🚺 Sara': 'if_sara',
+    '🇮🇹 🚹 Nicola': 'im_nicola',
+}
+
+# Custom voices are indexed in memory and kept current by a filesystem watcher (watchdog,
+# if installed) or by rescanning the folder every KOKORO_VOICE_POLL_SECONDS; 0 disables both
+VOICE_POLL_SECONDS = float(os.environ.get('KOKORO_VOICE_POLL_SECONDS', 2))
+
+class VoiceIndex:
+    """In-memory index of custom voice files, updated incrementally as the folder changes"""
+
+    def __init__(self, folder, on_change=None, poll_seconds=VOICE_POLL_SECONDS):
+        self.folder = folder
+        self.on_change = on_change
+        self.poll_seconds = poll_seconds
+        self.lock = threading.Lock()
+        # voice_id -> (path, mtime_ns, size); voices is the sorted {voice_id: path} lookups read
+        self.files = {}
+        self.voices = {}
+        self.mode = 'static'
+        self.scan(notify=False)
+
+    @staticmethod
+    def voice_id(path):
+        name = os.path.basename(path)
+        return f"custom_{name[:-3]}" if name.endswith('.pt') else None
+
+    def _update(self, changes, notify):
+        """Apply {voice_id: (path, mtime_ns, size) or None} and report what changed"""
+        with self.lock:
+            changed = {}
+            for voice, entry in changes.items():
+                if self.files.get(voice) == entry:
+                    continue
+                if entry is None:
+                    self.files.pop(voice, None)
+                else:
+                    self.files[voice] = entry
+                changed[voice] = entry[0] if entry else None
+            if changed:
+                self.voices = {voice: entry[0] for voice, entry in sorted(self.files.items())}
+        if notify and self.on_change:
+            for voice, path in changed.items():
+                self.on_change(voice, path)
+
+    def scan(self, notify=True):
+        """Rescan the whole folder"""
+        found = {}
+        try:
+            with os.scandir(self.folder) as entries:
+                for entry in entries:
+                    # Check if it's a .pt file (PyTorch model file)
+                    if entry.name.endswith('.pt') and entry.is_file():
+                        stat = entry.stat()
+                        found[self.voice_id(entry.name)] = (entry.path, stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            pass
+        changes = {voice: None for voice in self.files if voice not in found}
+        changes.update(found)
+        self._update(changes, notify)
+
+    def refresh_path(self, path):
+        """Re-check a single file after a watcher event"""
+        voice = self.voice_id(path)
+        if voice is None:
+            return
+        try:
+            stat = os.stat(path)
+            entry = (os.path.join(self.folder, os.path.basename(path)), stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            entry = None
+        self._update({voice: entry}, notify=True)
+
+    def start(self):
+        """Follow folder changes with watchdog, or poll when it is not installed"""
+        if self.poll_seconds <= 0:
+            return
+        try:
+            from watchdog.observers import Observer
+            from watchdog.events import FileSystemEventHandler
+
+            index = self
+            class Handler(FileSystemEventHandler):
+                def on_any_event(self, event):
+                    for path in (event.src_path, getattr(event, 'dest_path', None)):
+                        if path:
+                            index.refresh_path(os.fsdecode(path))
+
+            observer = Observer()
+            observer.schedule(Handler(), self.folder, recursive=False)
+            observer.daemon = True
+            observer.start()
+            self.mode = 'watchdog'
+        except Exception:
+            def poll():
+                while True:
+                    time.sleep(self.poll_seconds)
+                    self.scan()
+            threading.Thread(target=poll, name="voice-index-poll", daemon=True).start()
+            self.mode = f"polling every {self.poll_seconds:g}s"
+
+def _on_custom_voice_change(voice, path):
+    """Drop a changed or removed custom voice from memory and hot-load new versions"""
+    voice_store.discard(voice)
+    # Inline mixes that include the voice are stale too
+    for mixed in voice_store.resident():
+        if is_voice_formula(mixed) and voice in {term.split('*')[0].strip() for term in mixed.split('+')}:
+            voice_store.discard(mixed)
+    if path is None:
+        print(f"Custom voice removed: {voice}")
+        return
+    try:
+        get_voice_pack(voice)
+        print(f"Custom voice loaded: {voice}")
+    except EngineError as e:
+        # A file still being copied fails to load; its next change event retries
+        print(f"Warning: Could not load custom voice {voice}: {str(e)}")
+
+voice_index = VoiceIndex(custom_voices_folder, on_change=_on_custom_voice_change)
+voice_index.start()
+
+def custom_voice_index():
+    """Return {voice_id: file path} for the custom_voices folder"""
+    return voice_index.voices
+
+# Function to get custom voices from the custom_voices folder
+def get_custom_voices():
+    return {f"👤 Custom: {voice_id[len('custom_'):]}": voice_id for voice_id in custom_voice_index()}
+
+# Update choices with custom voices
+def update_voice_choices():
+    updated_choices = CHOICES.copy()
+    custom_voices = get_custom_voices()
+    updated_choices.update(custom_voices)
+    return updated_choices
+
+# Voice packs are kept in one memory-mapped bank file, so startup does not depend on the
+# number of voices and worker processes share one copy. Set KOKORO_VOICE_BANK to an
+# empty string to load every voice with torch.load instead
+VOICE_BANK_PATH = os.environ.get('KOKORO_VOICE_BANK', os.path.join(cache_base, 'voice_bank.bin'))
+voice_bank = VoiceBank(VOICE_BANK_PATH) if VOICE_BANK_PATH else None
+
+def voice_source(voice, voice_path=None):
+    """Fingerprint of what a voice pack is loaded from, used to spot stale voice bank entries"""
+    if voice_path is None:
+        return MODEL_REVISION
+    stat = os.stat(voice_path)
+    return f"{os.path.basename(voice_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+def get_voice_pack(voice):
+    """Return the voice pack for a voice id, loading it if it is not resident"""
+    pack = voice_store.get(voice)
+    if pack is not None:
+        return pack
+    with _once_lock(('voice', voice)):
+        # Another thread may have loaded it while this one waited
+        pack = voice_store.get(voice, count=False)
+        if pack is None:
+            start_time = time.perf_counter()
+            voice_path = None
+            if voice.startswith('custom_'):
+                # Load custom voice from the custom_voices folder
+                voice_path = custom_voice_index().get(voice)
+                
+                # Check if the file exists
+                if voice_path is None or not os.path.exists(voice_path):
+                    raise EngineError(f"Custom voice file not found: {voice[len('custom_'):]}.pt")
+            
+            source = voice_source(voice, voice_path)
+            pack = voice_bank.get(voice, source) if voice_bank is not None else None
+            if pack is None:
+                print(f"Voice {voice} not found in cache, loading now...")
+                if voice_path is not None:
+                    # Load the .pt file directly
+                    try:
+                        pack = torch.load(voice_path, weights_only=True)
+                    except Exception as e:
+                        raise EngineError(f"Error loading custom voice: {str(e)}")
+                else:
+                    pipeline = get_pipeline(voice[0])
+                    pack = _load_with_online_fallback(lambda: pipeline.load_voice(voice))
+                # Each add rewrites the bank, so only the fixed set of built-in voices is
+                # added on demand; custom voices join it through build_voice_bank()
+                if voice_bank is not None and voice_path is None and isinstance(pack, torch.Tensor):
+                    try:
+                        pack = voice_bank.add({voice: pack}, {voice: source})[voice]
+                    except Exception as e:
+                        print(f"Warning: Could not add {voice} to the voice bank: {str(e)}")
+            voice_store.put(voice, pack, time.perf_counter() - start_time)
+    return pack
+
+def debug_voice_store_stats():
+    """Debug function to print the resident voice set and load latency"""
+    print("\n=== VOICE STORE DEBUG ===")
+    print(f"Memory budget: {voice_store.memory_limit / (1024 * 1024):.0f} MB")
+    print(f"Custom voices indexed: {len(custom_voice_index())} ({voice_index.mode})")
+    for key, value in voice_store.stats().items():
+        print(f"{key}: {value}")
+    print("=== END DEBUG ===\n")
+
+def build_voice_bank():
+    """Write every built-in and custom voice into the voice bank in one pass"""
+    if voice_bank is None:
+        raise EngineError("The voice bank is disabled (KOKORO_VOICE_BANK is empty)")
+    from huggingface_hub import hf_hub_download
+    packs, sources = {}, {}
+    for voice in CHOICES.values():
+        try:
+            voice_path = _load_with_online_fallback(
+                lambda: hf_hub_download(repo_id="hexgrad/Kokoro-82M", filename=f"voices/{voice}.pt")
+            )
+            packs[voice] = torch.load(voice_path, weights_only=True)
+            sources[voice] = voice_source(voice)
+        except Exception as e:
+            print(f"Error loading voice {voice}: {str(e)}")
+    for voice, voice_path in custom_voice_index().items():
+        try:
+            pack = torch.load(voice_path, weights_only=True)
+        except Exception as e:
+            print(f"Error loading custom voice {voice}: {str(e)}")
+            continue
+        if isinstance(pack, torch.Tensor):
+            packs[voice] = pack
+            sources[voice] = voice_source(voice, voice_path)
+    voice_bank.add(packs, sources)
+    print(f"Voice bank written to {VOICE_BANK_PATH}: {len(packs)} voices, {voice_bank.stats()['size_mb']:.1f} MB")
+    return VOICE_BANK_PATH
+
+def debug_voice_bank_stats():
+    """Debug function to print the voice bank contents"""
+    print("\n=== VOICE BANK DEBUG ===")
+    print(f"Voice bank: {VOICE_BANK_PATH or 'disabled'}")
+    if voice_bank is not None:
+        for key, value in voice_bank.stats().items():
+            print(f"{key}: {value}")
+        print(f"Voices: {', '.join(sorted(voice_bank.index))}")
+    print("=== END DEBUG ===\n")
+
+def preload_voices(lang_codes):
+    """Eagerly load the pipelines and voices of the given languages"""
+    print(f"Preloading voices for languages: {', '.join(lang_codes)}")
+    for voice_name, voice_id in CHOICES.items():
+        if voice_id[0] not in lang_codes:
+            continue
+        print(f"Loading voice: {voice_name} ({voice_id})")
+        try:
+            get_voice_pack(voice_id)
+            print(f"Successfully loaded voice: {voice_name}")
+        except Exception as e:
+            print(f"Error loading voice {voice_name}: {str(e)}")
+    
+    # Custom voices are not preloaded; there can be thousands, and they load on demand
+    print(f"Voices preloaded. Resident voices: {len(voice_store)}")
+
+if WARM_LANGS:
+    preload_voices(WARM_LANGS)
+
+def forward(ps, ref_s, speed, backend='fp32'):
+    return device_manager.forward(ps, ref_s, speed, backend)
+
+# Number of segments sent through the model in one batched call, and how many
+# upcoming segments are buffered so they can be grouped by phoneme length
+BATCH_SIZE = 8
+BATCH_WINDOW = 32
+
+@torch.no_grad()
+def forward_batch(model, batch_ps, batch_ref_s, speed):
+    """Run several phoneme segments through KModel in one padded call.
+
+    The text side (PL-BERT, duration predictor, text encoder) is masked and runs
+    batched. The acoustic decoder normalizes over the whole time axis, so padded
+    frames would change its output; each item is decoded at its own length instead.
+    """
+    device = model.device
+    token_lists = []
+    for ps in batch_ps:
+        input_ids = [i for i in map(model.vocab.get, ps) if i is not None]
+        token_lists.append([0, *input_ids, 0])
+    input_lengths = torch.LongTensor([len(tokens) for tokens in token_lists])
+    input_ids = torch.zeros((len(token_lists), int(input_lengths.max())), dtype=torch.long)
+    for i, tokens in enumerate(token_lists):
+        input_ids[i, :len(tokens)] = torch.LongTensor(tokens)
+    input_ids = input_ids.to(device)
+    ref_s = torch.cat([r.reshape(1, -1) for r in batch_ref_s]).to(device)
+    # speed may be a single value or one value per item
+    speed = torch.as_tensor(speed, dtype=torch.float32, device=device).reshape(-1, 1)
+
+    text_mask = torch.arange(input_ids.shape[1]).unsqueeze(0) >= input_lengths.unsqueeze(1)
+    text_mask = text_mask.to(device)
+    bert_dur = model.bert(input_ids, attention_mask=(~text_mask).int())
+    d_en = model.bert_encoder(bert_dur).transpose(-1, -2)
+    s = ref_s[:, 128:]
+    d = model.predictor.text_encoder(d_en, s, input_lengths, text_mask)
+    x = torch.nn.utils.rnn.pack_padded_sequence(d, input_lengths, batch_first=True, enforce_sorted=False)
+    x, _ = model.predictor.lstm(x)
+    x, _ = torch.nn.utils.rnn.pad_packed_sequence(x, batch_first=True, total_length=input_ids.shape[1])
+    duration = torch.sigmoid(model.predictor.duration_proj(x)).sum(axis=-1) / speed
+    pred_dur = torch.round(duration).clamp(min=1).long()
+    t_en = model.text_encoder(input_ids, input_lengths, text_mask)
+
+    audios = []
+    for i, length in enumerate(input_lengths.tolist()):
+        indices = torch.repeat_interleave(torch.arange(length, device=device), pred_dur[i, :length])
+        pred_aln_trg = torch.zeros((length, indices.shape[0]), device=device)
+        pred_aln_trg[indices, torch.arange(indices.shape[0], device=device)] = 1
+        pred_aln_trg = pred_aln_trg.unsqueeze(0)
+        en = d[i:i + 1, :length].transpose(-1, -2) @ pred_aln_trg
+        F0_pred, N_pred = model.predictor.F0Ntrain(en, s[i:i + 1])
+        asr = t_en[i:i + 1, :, :length] @ pred_aln_trg
+        audio = model.decoder(asr, F0_pred, N_pred, ref_s[i:i + 1, :128]).squeeze()
+        audios.append(audio.cpu())
+    return audios
+
+def forward_many(batch_ps, batch_ref_s, speed, backend='fp32'):
+    """Synthesize a group of segments, falling back to one forward() call per segment.
+
+    speed may be a single value or a list with one value per segment.
+    """
+    speeds = speed if isinstance(speed, (list, tuple)) else [speed] * len(batch_ps)
+    # The ONNX graph takes one segment at a time
+    if len(batch_ps) == 1 or backend == 'onnx':
+        return [forward(ps, ref_s, s, backend) for ps, ref_s, s in zip(batch_ps, batch_ref_s, speeds)]
+    try:
+        return forward_batch(device_manager.model(backend), batch_ps, batch_ref_s, speeds)
+    except Exception as e:
+        print(f"Error with batched processing: {e}. Falling back to sequential processing.")
+        return [forward(ps, ref_s, s, backend) for ps, ref_s, s in zip(batch_ps, batch_ref_s, speeds)]
+
+# Cross-request micro-batching: handlers submit segments to one scheduler thread,
+# which waits up to SCHEDULER_MAX_WAIT_MS for more work before calling the model
+SCHEDULER_ENABLED = os.environ.get('KOKORO_SCHEDULER', '1') == '1'
+SCHEDULER_MAX_BATCH = int(os.environ.get('KOKORO_SCHEDULER_MAX_BATCH', 16))
+SCHEDULER_MAX_WAIT_MS = float(os.environ.get('KOKORO_SCHEDULER_MAX_WAIT_MS', 10))
+
+class InferenceScheduler:
+    """Collects (ps, ref_s, speed, backend) work items from concurrent handlers into batched model calls"""
+
+    def __init__(self, max_batch=SCHEDULER_MAX_BATCH, max_wait_ms=SCHEDULER_MAX_WAIT_MS):
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.worker = None
+        self.batch_sizes = Counter()
+        self.peak_queue_depth = 0
+
+    def submit(self, ps, ref_s, speed, backend='fp32'):
+        """Queue one segment and return a Future resolving to its audio tensor"""
+        with self.lock:
+            if self.worker is None:
+                self.worker = threading.Thread(target=self._run, name="inference-scheduler", daemon=True)
+                self.worker.start()
+        future = Future()
+        self.queue.put((ps, ref_s, speed, backend, future))
+        with self.lock:
+            self.peak_queue_depth = max(self.peak_queue_depth, self.queue.qsize())
+        return future
+
+    def _collect(self):
+        items = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(items) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                items.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    def _run(self):
+        while True:
+            groups = {}
+            for item in self._collect():
+                groups.setdefault(item[3], []).append(item)
+            # Each backend is a different model, so items are batched per backend
+            for backend, items in groups.items():
+                with self.lock:
+                    self.batch_sizes[len(items)] += 1
+                batch_ps, batch_ref_s, speeds, _, futures = zip(*items)
+                try:
+                    audios = forward_many(list(batch_ps), list(batch_ref_s), list(speeds), backend)
+                except Exception as e:
+                    for future in futures:
+                        future.set_exception(e)
+                    continue
+                for future, audio in zip(futures, audios):
+                    future.set_result(audio)
+
+    def stats(self):
+        """Return queue-depth and batch-size metrics"""
+        with self.lock:
+            batches = sum(self.batch_sizes.values())
+            items = sum(size * count for size, count in self.batch_sizes.items())
+            return {
+                'queue_depth': self.queue.qsize(),
+                'peak_queue_depth': self.peak_queue_depth,
+                'batches': batches,
+                'items': items,
+                'mean_batch_size': items / batches if batches else 0.0,
+                'batch_size_histogram': dict(sorted(self.batch_sizes.items())),
+            }
+
+scheduler = InferenceScheduler()
+
+def debug_scheduler_stats():
+    """Debug function to print the inference scheduler metrics"""
+    print("\n=== SCHEDULER DEBUG ===")
+    print(f"Enabled: {SCHEDULER_ENABLED} (max batch {scheduler.max_batch}, max wait {scheduler.max_wait * 1000:.0f} ms)")
+    for key, value in scheduler.stats().items():
+        print(f"{key}: {value}")
+    print("=== END DEBUG ===\n")
+
+# Identifies the model weights in audio cache keys; bump when the model changes
+MODEL_REVISION = 'hexgrad/Kokoro-82M@v1.0'
+
+# Segment audio cache. The disk tier lives under cache/audio_segments; set
+# KOKORO_AUDIO_CACHE_PATH to an empty string or KOKORO_AUDIO_CACHE_DISK_MB to 0 to keep
+# it in memory only
+AUDIO_CACHE_MEMORY_MB = float(os.environ.get('KOKORO_AUDIO_CACHE_MEMORY_MB', 256))
+AUDIO_CACHE_DISK_MB = float(os.environ.get('KOKORO_AUDIO_CACHE_DISK_MB', 2048))
+AUDIO_CACHE_PATH = os.environ.get('KOKORO_AUDIO_CACHE_PATH', os.path.join(cache_base, 'audio_segments'))
+# Segments waiting for the disk writer thread; when it falls this far behind, new
+# segments are kept in memory only instead of slowing synthesis down
+AUDIO_CACHE_WRITE_QUEUE = 64
+
+class AudioCache:
+    """Content-addressed cache of synthesized segments with memory and disk tiers evicted by size.
+
+    Disk files are read and written outside the lock, and writes happen on a background
+    thread, so lookups from other requests never wait on disk I/O.
+    """
+
+    def __init__(self, memory_mb=AUDIO_CACHE_MEMORY_MB, disk_mb=AUDIO_CACHE_DISK_MB, path=AUDIO_CACHE_PATH):
+        self.memory_limit = int(memory_mb * 1024 * 1024)
+        self.disk_limit = int(disk_mb * 1024 * 1024)
+        self.path = path if self.disk_limit > 0 else None
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.disk = OrderedDict()
+        self.disk_bytes = 0
+        self.pending = set()
+        self.writes = queue.Queue(maxsize=AUDIO_CACHE_WRITE_QUEUE)
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.skipped_writes = 0
+        if self.path:
+            os.makedirs(self.path, exist_ok=True)
+            # Rebuild the disk index, least recently used first
+            files = []
+            for root, _, names in os.walk(self.path):
+                for name in names:
+                    if name.endswith('.npy'):
+                        stat = os.stat(os.path.join(root, name))
+                        files.append((stat.st_mtime, name[:-4], stat.st_size))
+            for _, key, size in sorted(files):
+                self.disk[key] = size
+                self.disk_bytes += size
+            threading.Thread(target=self._write_loop, name="audio-cache-writer", daemon=True).start()
+            # Let queued entries reach the disk before the process exits
+            atexit.register(self.writes.join)
+
+    @staticmethod
+    def key(ps, ref_s, speed, backend='fp32'):
+        """Hash the phonemes, style vector, speed, model revision and backend of a segment"""
+        digest = hashlib.sha256()
+        digest.update(MODEL_REVISION.encode('utf-8'))
+        if backend != 'fp32':
+            # Other backends produce slightly different audio; fp32 keys predate the tag
+            digest.update(f"/{backend}".encode('utf-8'))
+        digest.update(ps.encode('utf-8'))
+        digest.update(repr(float(speed)).encode('utf-8'))
+        digest.update(ref_s.detach().cpu().to(torch.float32).contiguous().numpy().tobytes())
+        return digest.hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, key[:2], f"{key}.npy")
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return self.memory[key]
+            if key not in self.disk:
+                self.misses += 1
+                return None
+        try:
+            audio = torch.from_numpy(np.load(self._file(key)))
+            os.utime(self._file(key))
+        except Exception:
+            # Evicted meanwhile, or unreadable
+            with self.lock:
+                if key in self.disk:
+                    self.disk_bytes -= self.disk.pop(key)
+                self.misses += 1
+            return None
+        with self.lock:
+            if key in self.disk:
+                self.disk.move_to_end(key)
+            self._remember(key, audio)
+            self.hits += 1
+            self.disk_hits += 1
+        return audio
+
+    def put(self, key, audio):
+        with self.lock:
+            self._remember(key, audio)
+            if not self.path or key in self.disk or key in self.pending:
+                return
+            self.pending.add(key)
+        try:
+            self.writes.put_nowait((key, audio))
+        except queue.Full:
+            with self.lock:
+                self.pending.discard(key)
+                self.skipped_writes += 1
+
+    def _write_loop(self):
+        while True:
+            key, audio = self.writes.get()
+            try:
+                self._write(key, audio)
+            finally:
+                self.writes.task_done()
+
+    def _write(self, key, audio):
+        file_path = self._file(key)
+        try:
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            temp_path = f"{file_path}.{threading.get_ident()}.tmp"
+            with open(temp_path, 'wb') as f:
+                np.save(f, audio.numpy())
+            os.replace(temp_path, file_path)
+            size = os.path.getsize(file_path)
+        except Exception as e:
+            print(f"Warning: Could not write audio cache entry: {str(e)}")
+            with self.lock:
+                self.pending.discard(key)
+            return
+        evicted = []
+        with self.lock:
+            self.pending.discard(key)
+            self.disk[key] = size
+            self.disk_bytes += size
+            while self.disk_bytes > self.disk_limit and self.disk:
+                old_key, old_size = self.disk.popitem(last=False)
+                self.disk_bytes -= old_size
+                evicted.append(old_key)
+        for old_key in evicted:
+            try:
+                os.remove(self._file(old_key))
+            except OSError:
+                pass
+
+    def _remember(self, key, audio):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return
+        self.memory[key] = audio
+        self.memory_bytes += audio.numel() * audio.element_size()
+        while self.memory_bytes > self.memory_limit and self.memory:
+            _, old_audio = self.memory.popitem(last=False)
+            self.memory_bytes -= old_audio.numel() * old_audio.element_size()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'memory_entries': len(self.memory),
+                'memory_mb': self.memory_bytes / (1024 * 1024),
+                'disk_entries': len(self.disk),
+                'disk_mb': self.disk_bytes / (1024 * 1024),
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'queued_writes': self.writes.qsize(),
+                'skipped_writes': self.skipped_writes,
+            }
+
+audio_cache = AudioCache()
+
+def debug_audio_cache_stats():
+    """Debug function to print the segment audio cache counters"""
+    print("\n=== AUDIO CACHE DEBUG ===")
+    print(f"Disk tier: {audio_cache.path or 'disabled'}")
+    for key, value in audio_cache.stats().items():
+        print(f"{key}: {value}")
+    print("=== END DEBUG ===\n")
+
+def synthesize_window(window, pack, speed, backend='fp32'):
+    """Synthesize buffered segments in batches of similar phoneme length, keeping input order.
+
+    Segments already in the audio cache are returned from it without calling the model.
+    """
+    results = [None] * len(window)
+    keys = {}
+    for i, ps in enumerate(window):
+        key = audio_cache.key(ps, pack[len(ps)-1], speed, backend)
+        results[i] = audio_cache.get(key)
+        if results[i] is None:
+            keys[i] = key
+    order = sorted(keys, key=lambda i: len(window[i]))
+    if SCHEDULER_ENABLED:
+        # Submit in length order so the scheduler sees similar lengths side by side
+        futures = {i: scheduler.submit(window[i], pack[len(window[i])-1], speed, backend) for i in order}
+        for i, future in futures.items():
+            results[i] = future.result()
+    else:
+        for start in range(0, len(order), BATCH_SIZE):
+            indices = order[start:start + BATCH_SIZE]
+            batch_ps = [window[i] for i in indices]
+            batch_ref_s = [pack[len(ps)-1] for ps in batch_ps]
+            for i, audio in zip(indices, forward_many(batch_ps, batch_ref_s, speed, backend)):
+                results[i] = audio
+    for i in order:
+        audio_cache.put(keys[i], results[i])
+    return results
+
+def synthesize_segments(segments, pack, speed, backend='fp32'):
+    """Yield the audio for each phoneme segment in order, batching up to BATCH_WINDOW at a time"""
+    window = []
+    for ps in segments:
+        window.append(ps)
+        if len(window) >= BATCH_WINDOW:
+            yield from synthesize_window(window, pack, speed, backend)
+            window = []
+    if window:
+        yield from synthesize_window(window, pack, speed, backend)
+
+# Number of phonemized segments the G2P thread may run ahead of the model
+G2P_PREFETCH = 16
+
+class PhonemePrefetcher:
+    """Runs G2P on a background thread so phonemization overlaps with model inference.
+
+    Iterating yields the phoneme segments of `source` in order, with at most
+    `maxsize` segments phonemized ahead of the consumer.
+    """
+    _DONE = object()
+
+    def __init__(self, source, maxsize=G2P_PREFETCH):
+        self.source = source
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.stopped = threading.Event()
+        self.g2p_seconds = 0.0
+        self.wait_seconds = 0.0
+        self.thread = threading.Thread(target=self._produce, name="g2p-prefetch", daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _produce(self):
+        iterator = iter(self.source)
+        while not self.stopped.is_set():
+            start = time.perf_counter()
+            try:
+                ps = next(iterator)
+            except StopIteration:
+                self._put((self._DONE, None))
+                return
+            except Exception as e:
+                self._put((self._DONE, e))
+                return
+            finally:
+                self.g2p_seconds += time.perf_counter() - start
+            self._put((ps, None))
+
+    def __iter__(self):
+        try:
+            while True:
+                start = time.perf_counter()
+                ps, error = self.queue.get()
+                self.wait_seconds += time.perf_counter() - start
+                if ps is self._DONE:
+                    if error is not None:
+                        raise error
+                    return
+                yield ps
+        finally:
+            self.stopped.set()
+
+    def report(self, wall_seconds):
+        """Print per-stage timing and the wall-clock time saved by overlapping the stages"""
+        model_seconds = wall_seconds - self.wait_seconds
+        saved_seconds = self.g2p_seconds + model_seconds - wall_seconds
+        print(f"⏱️  G2P: {self.g2p_seconds:.2f}s, model: {model_seconds:.2f}s, wall: {wall_seconds:.2f}s "
+              f"(overlap saved {saved_seconds:.2f}s)")
+
+# Largest per-sample difference debug_batch_parity accepts between the batched and
+# sequential paths; float reordering in padded batches stays orders of magnitude below it
+BATCH_PARITY_TOLERANCE = 1e-4
+
+def debug_batch_parity(text, voice='af_heart', speed=1, tolerance=BATCH_PARITY_TOLERANCE):
+    """Debug function comparing batched synthesis against the sequential forward() path.
+
+    Returns True when every segment has the same length on both paths and no sample
+    differs by more than tolerance.
+    """
+    pack = get_voice_pack(voice)
+    segments = [ps for _, ps in phonemize(voice[0], text)]
+    # The vocoder draws random phase and noise per segment. Both paths decode the segments
+    # in the same order, so the same seed makes them draw the same values
+    torch.manual_seed(0)
+    sequential = [forward(ps, pack[len(ps)-1], speed) for ps in segments]
+    # Call the batched path directly so the audio cache cannot answer for it
+    torch.manual_seed(0)
+    batched = []
+    for start in range(0, len(segments), BATCH_SIZE):
+        batch_ps = segments[start:start + BATCH_SIZE]
+        batched.extend(forward_many(batch_ps, [pack[len(ps)-1] for ps in batch_ps], speed))
+    print("\n=== BATCH PARITY DEBUG ===")
+    max_diff = 0.0
+    for i, (a, b) in enumerate(zip(sequential, batched)):
+        if a.shape != b.shape:
+            print(f"Segment {i}: length mismatch {a.shape[-1]} vs {b.shape[-1]}")
+            max_diff = float('inf')
+            continue
+        diff = (a - b).abs().max().item()
+        max_diff = max(max_diff, diff)
+        print(f"Segment {i}: {a.shape[-1]} samples, max abs diff {diff:.2e}")
+    passed = max_diff <= tolerance
+    print(f"Max abs diff over {len(segments)} segments: {max_diff:.2e} "
+          f"({'PASS' if passed else 'FAIL'}, tolerance {tolerance:.0e})")
+    print("=== END DEBUG ===\n")
+    return passed
+
+# Output file formats. WAV is written directly at the model's 24 kHz; the other formats,
+# and WAV at another sample rate, are encoded by ffmpeg
+WAV_SAMPLE_FORMAT = os.environ.get('KOKORO_WAV_FORMAT', 'pcm16').lower()
+OUTPUT_SAMPLE_RATE = int(os.environ.get('KOKORO_OUTPUT_SAMPLE_RATE', 24000))
+MP3_BITRATE = os.environ.get('KOKORO_MP3_BITRATE', '192k')
+OPUS_BITRATE = os.environ.get('KOKORO_OPUS_BITRATE', '32k')
+
+# File extension of each output format
+OUTPUT_FORMATS = {
+    'WAV': 'wav',
+    'MP3': 'mp3',
+    'FLAC': 'flac',
+    'OPUS': 'ogg',
+}
+
+def output_extension(output_format):
+    return OUTPUT_FORMATS.get(output_format.upper(), 'wav')
+
+def encoder_args(output_format):
+    """ffmpeg output arguments for a format, or None when the WAV writer can produce it"""
+    output_format = output_format.upper()
+    if output_format == 'MP3':
+        args = ['-codec:a', 'libmp3lame', '-b:a', MP3_BITRATE]
+    elif output_format == 'FLAC':
+        args = ['-codec:a', 'flac', '-sample_fmt', 's16']
+    elif output_format == 'OPUS':
+        args = ['-codec:a', 'libopus', '-b:a', OPUS_BITRATE]
+    elif OUTPUT_SAMPLE_RATE != 24000:
+        args = ['-codec:a', 'pcm_s16le' if WAV_SAMPLE_FORMAT == 'pcm16' else 'pcm_f32le']
+    else:
+        return None
+    if OUTPUT_SAMPLE_RATE != 24000:
+        args += ['-ar', str(OUTPUT_SAMPLE_RATE)]
+    return args
+
+def get_ffmpeg_exe():
+    """Path of the ffmpeg binary from imageio-ffmpeg or the PATH, or None"""
+    try:
+        import imageio_ffmpeg
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except Exception:
+        return shutil.which('ffmpeg')
+
+def convert_audio_file(input_wav_path, output_path, output_format):
+    """Convert a WAV file to output_format using ffmpeg"""
+    try:
+        ffmpeg_path = get_ffmpeg_exe()
+        if ffmpeg_path is None:
+            print("❌ ffmpeg not available. Please install it with: pip install imageio-ffmpeg")
+            return False
+        
+        # Get input file size for progress info
+        input_size_mb = os.path.getsize(input_wav_path) / (1024 * 1024)
+        print(f"🔄 Converting {input_size_mb:.1f} MB WAV to {output_format.upper()}...")
+        
+        # Build ffmpeg command
+        cmd = [
+            ffmpeg_path,
+            '-i', input_wav_path,
+            *encoder_args(output_format),
+            '-y',  # Overwrite output file if it exists
+            output_path
+        ]
+        
+        print(f"⚙️  Running FFmpeg conversion...")
+        # Run ffmpeg command
+        result = subprocess.run(cmd, capture_output=True, text=True)
+        
+        if result.returncode == 0:
+            print(f"✅ {output_format.upper()} conversion completed successfully!")
+            return True
+        else:
+            print(f"❌ FFmpeg conversion failed!")
+            print(f"Error details: {result.stderr}")
+            return False
+            
+    except Exception as e:
+        print(f"❌ Error during {output_format.upper()} conversion: {str(e)}")
+        return False
+
+# Background encoders for batch conversion to compressed formats
+ENCODER_WORKERS = int(os.environ.get('KOKORO_ENCODER_WORKERS', 2))
+ENCODER_QUEUE = int(os.environ.get('KOKORO_ENCODER_QUEUE', 4))
+
+class EncoderPool:
+    """Converts finished WAV files to the output format on worker threads while synthesis moves on.
+
+    At most `max_queued` files wait for a free encoder; submitting beyond that blocks, so
+    finished PCM cannot pile up on disk faster than it is encoded. `max_depth_seen` records
+    the most files that were ever waiting at once.
+    """
+
+    def __init__(self, workers=ENCODER_WORKERS, max_queued=ENCODER_QUEUE):
+        self.workers = max(1, workers)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="encoder")
+        self.slots = threading.BoundedSemaphore(self.workers + max(0, max_queued))
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.max_depth_seen = 0
+        self.encode_times = []
+        self.blocked_seconds = 0.0
+
+    def submit(self, wav_path, output_path, output_format):
+        """Queue wav_path for encoding to output_path; the future yields the final file's path"""
+        start_time = time.perf_counter()
+        self.slots.acquire()
+        with self.lock:
+            self.blocked_seconds += time.perf_counter() - start_time
+            self.queued += 1
+            self.max_depth_seen = max(self.max_depth_seen, self.queued)
+        return self.executor.submit(self._encode, wav_path, output_path, output_format)
+
+    def _encode(self, wav_path, output_path, output_format):
+        with self.lock:
+            self.queued -= 1
+            self.running += 1
+        start_time = time.perf_counter()
+        try:
+            if convert_audio_file(wav_path, output_path, output_format):
+                os.remove(wav_path)
+                return output_path
+            # Keep the WAV under the name the encoded file would have had
+            fallback_path = f"{os.path.splitext(output_path)[0]}.wav"
+            os.replace(wav_path, fallback_path)
+            return fallback_path
+        finally:
+            elapsed = time.perf_counter() - start_time
+            with self.lock:
+                self.running -= 1
+                self.encode_times.append(elapsed)
+                depth = self.queued
+            self.slots.release()
+            print(f"🎧 Encoded {os.path.basename(output_path)} in {elapsed:.1f} seconds ({depth} waiting)")
+
+    def depth(self):
+        """Files waiting for an encoder, not counting those being encoded"""
+        with self.lock:
+            return self.queued
+
+    def shutdown(self):
+        """Wait for every queued encode to finish"""
+        self.executor.shutdown(wait=True)
+
+    def stats(self):
+        with self.lock:
+            encode_times = list(self.encode_times)
+            return {
+                'workers': self.workers,
+                'encoded': len(encode_times),
+                'queued': self.queued,
+                'running': self.running,
+                'max_depth_seen': self.max_depth_seen,
+                'encode_seconds_mean': sum(encode_times) / len(encode_times) if encode_times else 0.0,
+                'encode_seconds_p95': percentile(encode_times, 95),
+                # Time synthesis spent waiting for a free queue slot
+                'blocked_seconds': self.blocked_seconds,
+            }
+
+# G2P cache: phonemized segments keyed by (lang_code, normalized text). The disk store
+# survives restarts; set KOKORO_G2P_CACHE_PATH to an empty string to keep it in memory only
+G2P_CACHE_SIZE = int(os.environ.get('KOKORO_G2P_CACHE_SIZE', 4096))
+G2P_CACHE_PATH = os.environ.get('KOKORO_G2P_CACHE_PATH', os.path.join(cache_base, 'g2p_cache.sqlite'))
+G2P_DISK_MAX_ENTRIES = int(os.environ.get('KOKORO_G2P_DISK_MAX_ENTRIES', 200000))
+
+try:
+    from importlib.metadata import version as package_version
+    G2P_VERSION = f"misaki-{package_version('misaki')}"
+except Exception:
+    G2P_VERSION = "misaki-unknown"
+
+# Disk hits whose last_used time is buffered before it is written back in one transaction
+G2P_TOUCH_BATCH = 64
+
+class PhonemeCache:
+    """LRU cache of KPipeline phonemization results with an optional SQLite store on disk.
+
+    The store's row count is kept in memory and last_used updates from disk hits are
+    written in batches, so lookups and inserts never scan the table or commit per hit.
+    """
+
+    def __init__(self, max_entries=G2P_CACHE_SIZE, path=G2P_CACHE_PATH, max_disk_entries=G2P_DISK_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.db = None
+        self.disk_entries = 0
+        self.touched = {}
+        if path:
+            try:
+                self.db = sqlite3.connect(path, check_same_thread=False)
+                self.db.execute(
+                    "CREATE TABLE IF NOT EXISTS g2p (lang TEXT, text TEXT, version TEXT, segments TEXT, "
+                    "last_used REAL, PRIMARY KEY (lang, text, version))"
+                )
+                self.db.commit()
+                self.disk_entries = self.db.execute("SELECT COUNT(*) FROM g2p").fetchone()[0]
+            except Exception as e:
+                print(f"Warning: Could not open G2P cache at {path}: {str(e)}")
+                self.db = None
+            else:
+                atexit.register(self.flush)
+
+    def get(self, lang_code, text):
+        """Return the cached [(graphemes, phonemes), ...] for a segment, or None"""
+        key = (lang_code, text)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            if self.db is not None:
+                row = self.db.execute(
+                    "SELECT segments FROM g2p WHERE lang = ? AND text = ? AND version = ?",
+                    (lang_code, text, G2P_VERSION)
+                ).fetchone()
+                if row is not None:
+                    self.touched[key] = time.time()
+                    if len(self.touched) >= G2P_TOUCH_BATCH:
+                        self._write_touched()
+                        self.db.commit()
+                    segments = [tuple(segment) for segment in json.loads(row[0])]
+                    self._remember(key, segments)
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return segments
+            self.misses += 1
+            return None
+
+    def put(self, lang_code, text, segments):
+        with self.lock:
+            self._remember((lang_code, text), segments)
+            if self.db is not None:
+                # G2P output for a key is deterministic, so a row another thread already wrote is kept
+                self.disk_entries += self.db.execute(
+                    "INSERT OR IGNORE INTO g2p VALUES (?, ?, ?, ?, ?)",
+                    (lang_code, text, G2P_VERSION, json.dumps(segments, ensure_ascii=False), time.time())
+                ).rowcount
+                # Trim the least recently used rows once the store grows past its limit
+                if self.disk_entries > self.max_disk_entries:
+                    self._write_touched()
+                    self.disk_entries -= self.db.execute(
+                        "DELETE FROM g2p WHERE rowid IN (SELECT rowid FROM g2p ORDER BY last_used LIMIT ?)",
+                        (max(1, self.max_disk_entries // 10),)
+                    ).rowcount
+                self.db.commit()
+
+    def _write_touched(self):
+        """Write buffered last_used times; the caller commits"""
+        if self.touched:
+            self.db.executemany(
+                "UPDATE g2p SET last_used = ? WHERE lang = ? AND text = ? AND version = ?",
+                [(used, lang_code, text, G2P_VERSION) for (lang_code, text), used in self.touched.items()]
+            )
+            self.touched.clear()
+
+    def flush(self):
+        """Write buffered last_used times to disk"""
+        with self.lock:
+            if self.db is not None and self.touched:
+                self._write_touched()
+                self.db.commit()
+
+    def _remember(self, key, segments):
+        self.entries[key] = segments
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        """Return hit and miss counters for sizing the cache"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'disk_entries': self.disk_entries,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+g2p_cache = PhonemeCache()
+
+def normalize_text(text):
+    """Normalize a text segment for G2P: NFC form, trimmed, with runs of spaces collapsed"""
+    text = unicodedata.normalize('NFC', text)
+    return '\n'.join(re.sub(r'[ \t]+', ' ', line).strip() for line in text.strip().splitlines())
+
+def phonemize(lang_code, text):
+    """Yield the (graphemes, phonemes) segments KPipeline produces for text, using the G2P cache"""
+    text = normalize_text(text)
+    segments = g2p_cache.get(lang_code, text)
+    if segments is not None:
+        yield from segments
+        return
+    segments = []
+    results = get_pipeline(lang_code)(text, None)
+    lock = _once_lock(('g2p', lang_code))
+    while True:
+        # The G2P backends (espeak in particular) are not thread-safe, so only one thread
+        # phonemizes with a pipeline at a time. The lock is held per segment, not across the
+        # yield, so concurrent requests interleave between segments
+        with lock:
+            result = next(results, None)
+        if result is None:
+            break
+        graphemes, ps, _ = result
+        segments.append((graphemes, ps))
+        yield graphemes, ps
+    g2p_cache.put(lang_code, text, segments)
+
+# Where text may be split, from most to least natural. Each match ends a piece, so the
+# pieces concatenate back to the original text
+_SENTENCE_BREAK = re.compile(r'[.!?…。！？]+["\'”’»)\]]*\s+|\n+')
+_CLAUSE_BREAK = re.compile(r'[,;:]["\'”’»)\]]*\s+|\s*[—–]\s*')
+_WORD_BREAK = re.compile(r'\s+')
+
+def estimate_phonemes(text):
+    """Rough phoneme count of text: one per character, more for digits that get spelled out"""
+    return len(text) + 2 * sum(c.isdigit() for c in text)
+
+def _split_after(text, pattern):
+    pieces = []
+    start = 0
+    for match in pattern.finditer(text):
+        if match.end() > start:
+            pieces.append(text[start:match.end()])
+            start = match.end()
+    pieces.append(text[start:])
+    return [piece for piece in pieces if piece]
+
+def _split_long(piece, limit, patterns=(_CLAUSE_BREAK, _WORD_BREAK)):
+    """Split a piece costing more than limit at clause, then word boundaries, then anywhere"""
+    if estimate_phonemes(piece) <= limit:
+        return [piece]
+    if not patterns:
+        # Cut anywhere, by estimated cost rather than characters so digit runs stay under limit
+        parts = ['']
+        cost = 0
+        for char in piece:
+            char_cost = estimate_phonemes(char)
+            if parts[-1] and cost + char_cost > limit:
+                parts.append('')
+                cost = 0
+            parts[-1] += char
+            cost += char_cost
+        return parts
+    return [p for part in _split_after(piece, patterns[0]) for p in _split_long(part, limit, patterns[1:])]
+
+def segment_text(text, target=None):
+    """Split text at sentence and clause boundaries into segments of roughly equal phoneme cost.
+
+    The segment count is chosen from the total cost and the target, then sentences are packed
+    so every segment lands near the same size instead of one full chunk plus a remainder.
+    No segment exceeds SEGMENT_LIMIT (400) estimated phonemes, the size KPipeline's non-English
+    path re-splits at, which also keeps English segments clear of the model's 510 token context.
+    Larger targets are clamped to it.
+    """
+    target = min(max(1, target or SEGMENT_CHARS), SEGMENT_LIMIT)
+    limit = min(2 * target, SEGMENT_LIMIT)
+    pieces = [p for piece in _split_after(text, _SENTENCE_BREAK) for p in _split_long(piece, limit)]
+    total = sum(estimate_phonemes(piece) for piece in pieces)
+    if not total:
+        return []
+    goal = total / math.ceil(total / target)
+    
+    segments = []
+    current = ''
+    current_cost = 0
+    for piece in pieces:
+        cost = estimate_phonemes(piece)
+        # Close the segment at whichever boundary lands nearer the goal, never past the limit
+        if current and (current_cost + cost / 2 > goal or current_cost + cost > limit):
+            segments.append(current)
+            current = ''
+            current_cost = 0
+        current += piece
+        current_cost += cost
+    segments.append(current)
+    return [segment.strip() for segment in segments if segment.strip()]
+
+def debug_g2p_cache_stats():
+    """Debug function to print the G2P cache counters"""
+    print("\n=== G2P CACHE DEBUG ===")
+    print(f"Disk store: {G2P_CACHE_PATH if g2p_cache.db is not None else 'disabled'}")
+    for key, value in g2p_cache.stats().items():
+        print(f"{key}: {value}")
+    print("=== END DEBUG ===\n")
+
+def resolve_voice(voice):
+    """Map a voice display name or id to (voice_id, lang_code, voice pack), loading the pack if needed"""
+    # Inline voice formulas are mixed in memory
+    if is_voice_formula(voice):
+        voice, pack = get_mixed_voice(voice)
+        # Pronounce with the language of the most heavily weighted voice
+        main_voice = max(parse_voice_formula(voice), key=lambda term: term[1])[0]
+        lang_code = 'a' if main_voice.startswith('custom_') else main_voice[0]
+        return voice, lang_code, pack
+    # Check if the voice is a display name from standard voices
+    if voice in CHOICES:
+        voice = CHOICES[voice]
+    # Check if the voice is a custom voice display name
+    elif voice.startswith('👤 Custom:'):
+        custom_voices = get_custom_voices()
+        if voice in custom_voices:
+            voice = custom_voices[voice]
+        else:
+            raise EngineError(f"Custom voice not found: {voice}")
+    
+    # Determine if this is a custom voice
+    is_custom = voice.startswith('custom_')
+    
+    # Use the appropriate pipeline
+    if is_custom:
+        lang_code = 'a'  # Use American English pipeline for custom voices
+    else:
+        lang_code = voice[0]
+    
+    # Get voice from in-memory cache or load it
+    pack = get_voice_pack(voice)
+    
+    return voice, lang_code, pack
+
+# Output store: an SQLite index of the files in the outputs folder. Age and size limits of
+# 0 keep files forever; identical renders are hard-linked either way
+OUTPUT_INDEX_PATH = os.environ.get('KOKORO_OUTPUT_INDEX', os.path.join(cache_base, 'outputs.sqlite'))
+OUTPUT_MAX_MB = float(os.environ.get('KOKORO_OUTPUT_MAX_MB', 0))
+OUTPUT_MAX_AGE_DAYS = float(os.environ.get('KOKORO_OUTPUT_MAX_AGE_DAYS', 0))
+
+class OutputStore:
+    """Index of generated files with retention limits and deduplication of identical renders.
+
+    A registered file whose content matches a stored file is replaced by a hard link to it.
+    Files unused for longer than max_age_days are deleted, then the least recently used
+    ones until the folder fits in max_mb.
+    """
+
+    def __init__(self, folder=output_folder, path=OUTPUT_INDEX_PATH, max_mb=OUTPUT_MAX_MB, max_age_days=OUTPUT_MAX_AGE_DAYS):
+        self.folder = os.path.abspath(folder)
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.max_age = max_age_days * 24 * 3600
+        self.lock = threading.Lock()
+        self.linked = 0
+        self.linked_bytes = 0
+        self.evictions = 0
+        self.db = None
+        if path:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+                self.db = sqlite3.connect(path, check_same_thread=False)
+                self.db.execute(
+                    "CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, hash TEXT, duration REAL, voice TEXT, "
+                    "size INTEGER, created REAL, last_used REAL)"
+                )
+                self.db.execute("CREATE INDEX IF NOT EXISTS files_hash ON files (hash)")
+                self.db.commit()
+                self.scan()
+            except Exception as e:
+                print(f"Warning: Could not open output index at {path}: {str(e)}")
+                self.db = None
+
+    def scan(self):
+        """Index files in the folder that are not tracked yet and forget entries whose file is gone.
+
+        Untracked files, such as Gradio's copies or files from before the index existed, are
+        not hashed; they count toward the limits but are never linked.
+        """
+        if self.db is None:
+            return
+        with self.lock:
+            known = {row[0] for row in self.db.execute("SELECT path FROM files")}
+            present = set()
+            for root, _, names in os.walk(self.folder):
+                for name in names:
+                    if name.endswith('.tmp'):
+                        continue
+                    file_path = os.path.join(root, name)
+                    present.add(file_path)
+                    if file_path not in known:
+                        stat = os.stat(file_path)
+                        self.db.execute(
+                            "INSERT INTO files VALUES (?, NULL, NULL, NULL, ?, ?, ?)",
+                            (file_path, stat.st_size, stat.st_mtime, stat.st_mtime)
+                        )
+            self.db.executemany("DELETE FROM files WHERE path = ?", [(file_path,) for file_path in known - present])
+            self._enforce()
+            self.db.commit()
+
+    @staticmethod
+    def _hash(file_path):
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            while chunk := f.read(1024 * 1024):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def register(self, file_path, duration=None, voice=None):
+        """Index a finished file, linking it to an identical stored file, then apply the limits"""
+        if self.db is None:
+            return file_path
+        file_path = os.path.abspath(file_path)
+        digest = self._hash(file_path)
+        size = os.path.getsize(file_path)
+        now = time.time()
+        with self.lock:
+            for (other_path,) in self.db.execute(
+                "SELECT path FROM files WHERE hash = ? AND size = ? AND path != ?", (digest, size, file_path)
+            ).fetchall():
+                if not os.path.exists(other_path):
+                    continue
+                temp_path = f"{file_path}.{threading.get_ident()}.tmp"
+                try:
+                    os.link(other_path, temp_path)
+                    os.replace(temp_path, file_path)
+                except OSError as e:
+                    # e.g. a filesystem without hard links; keep the separate copy
+                    print(f"Warning: Could not link {os.path.basename(file_path)} to an identical output: {str(e)}")
+                    if os.path.exists(temp_path):
+                        os.remove(temp_path)
+                else:
+                    self.linked += 1
+                    self.linked_bytes += size
+                    print(f"🔗 {os.path.basename(file_path)} is identical to {os.path.basename(other_path)}; stored once")
+                    # Rendering the same audio again counts as using the stored copy
+                    self.db.execute("UPDATE files SET last_used = ? WHERE hash = ?", (now, digest))
+                break
+            self.db.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (file_path, digest, duration, voice, size, now, now)
+            )
+            self._enforce(keep=file_path)
+            self.db.commit()
+        return file_path
+
+    def move(self, old_path, new_path):
+        """Follow a tracked file that was renamed"""
+        if self.db is None:
+            return
+        with self.lock:
+            self.db.execute("UPDATE files SET path = ? WHERE path = ?", (os.path.abspath(new_path), os.path.abspath(old_path)))
+            self.db.commit()
+
+    def release(self, file_path):
+        """Stop tracking a file, e.g. one about to be converted or moved elsewhere, and return its duration"""
+        if self.db is None:
+            return None
+        file_path = os.path.abspath(file_path)
+        with self.lock:
+            row = self.db.execute("SELECT duration FROM files WHERE path = ?", (file_path,)).fetchone()
+            self.db.execute("DELETE FROM files WHERE path = ?", (file_path,))
+            self.db.commit()
+        return row[0] if row else None
+
+    def _stored_bytes(self):
+        # Files with the same hash are hard links sharing one copy on disk
+        linked = self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM (SELECT MAX(size) AS size FROM files WHERE hash IS NOT NULL GROUP BY hash)"
+        ).fetchone()[0]
+        unlinked = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM files WHERE hash IS NULL").fetchone()[0]
+        return linked + unlinked
+
+    def _remove(self, file_path):
+        try:
+            os.remove(file_path)
+        except OSError:
+            pass
+        self.db.execute("DELETE FROM files WHERE path = ?", (file_path,))
+        self.evictions += 1
+
+    def _enforce(self, keep=None):
+        """Delete expired files, then least recently used ones until the size limit holds"""
+        removed = 0
+        if self.max_age > 0:
+            for (file_path,) in self.db.execute(
+                "SELECT path FROM files WHERE last_used < ? AND path IS NOT ?", (time.time() - self.max_age, keep)
+            ).fetchall():
+                self._remove(file_path)
+                removed += 1
+        if self.max_bytes > 0:
+            stored_bytes = self._stored_bytes()
+            if stored_bytes > self.max_bytes:
+                for file_path, digest, size in self.db.execute(
+                    "SELECT path, hash, size FROM files WHERE path IS NOT ? ORDER BY last_used", (keep,)
+                ).fetchall():
+                    if stored_bytes <= self.max_bytes:
+                        break
+                    self._remove(file_path)
+                    removed += 1
+                    # A linked file only frees its space once its last link is gone
+                    if digest is None or not self.db.execute("SELECT 1 FROM files WHERE hash = ?", (digest,)).fetchone():
+                        stored_bytes -= size
+        if removed:
+            print(f"🧹 Removed {removed} old output files")
+
+    def stats(self):
+        if self.db is None:
+            return {'enabled': False}
+        with self.lock:
+            files, total_bytes = self.db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM files").fetchone()
+            return {
+                'files': files,
+                'stored_mb': self._stored_bytes() / (1024 * 1024),
+                'apparent_mb': total_bytes / (1024 * 1024),
+                'linked': self.linked,
+                'linked_mb': self.linked_bytes / (1024 * 1024),
+                'evictions': self.evictions,
+            }
+
+output_store = OutputStore()
+
+def debug_output_store_stats():
+    """Debug function to print the output store counters"""
+    print("\n=== OUTPUT STORE DEBUG ===")
+    print(f"Index: {OUTPUT_INDEX_PATH or 'disabled'}")
+    print(f"Limits: {OUTPUT_MAX_MB or 'no'} MB, {OUTPUT_MAX_AGE_DAYS or 'no'} days")
+    for key, value in output_store.stats().items():
+        print(f"{key}: {value}")
+    print("=== END DEBUG ===\n")
+
+def new_output_stem(prefix='audio'):
+    """Timestamped path without extension in the outputs folder that no output file uses yet"""
+    stem = os.path.join(output_folder, f"{prefix}_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+    candidate = stem
+    n = 1
+    # Several files can finish within the same second, e.g. in batch conversion
+    while any(os.path.exists(f"{candidate}.{extension}") for extension in OUTPUT_FORMATS.values()):
+        candidate = f"{stem}_{n}"
+        n += 1
+    return candidate
+
+def open_audio_file(output_format='WAV', prefix='audio'):
+    """Open a writer for a new file in the outputs folder.
+
+    Formats that need ffmpeg are encoded while segments are still being synthesized; if
+    ffmpeg cannot be started a WAV is written instead and converted when it is finished.
+    """
+    stem = new_output_stem(prefix)
+    args = encoder_args(output_format)
+    if args is not None:
+        ffmpeg_path = get_ffmpeg_exe()
+        if ffmpeg_path:
+            try:
+                # FLAC and 16-bit WAV store integer samples, which cannot hold peaks above full scale
+                limit = output_format.upper() == 'FLAC' or (output_format.upper() == 'WAV' and WAV_SAMPLE_FORMAT == 'pcm16')
+                return FfmpegEncoder(f"{stem}.{output_extension(output_format)}", 24000, ffmpeg_path, args, limit)
+            except OSError as e:
+                print(f"Warning: Could not start ffmpeg, writing WAV first: {str(e)}")
+        else:
+            print("❌ ffmpeg not available. Please install it with: pip install imageio-ffmpeg")
+    return WavWriter(f"{stem}.wav", 24000, sample_format=WAV_SAMPLE_FORMAT)
+
+def finish_audio_file(writer, output_format='WAV', voice=None):
+    """Close a writer, convert its file if needed and add it to the output store.
+
+    Returns (audio_filepath, is_large_file).
+    """
+    try:
+        writer.close()
+    except OSError as e:
+        raise EngineError(f"Audio encoding failed: {str(e)}")
+    audio_filepath = writer.path
+    
+    print(f"Audio generation complete!")
+    print(f"Audio length: {writer.seconds:.1f} seconds ({writer.seconds/60:.1f} minutes)")
+    
+    if not isinstance(writer, FfmpegEncoder) and encoder_args(output_format) is not None:
+        # ffmpeg could not encode while synthesizing; convert the finished WAV instead
+        wav_filepath = writer.path
+        output_path = f"{os.path.splitext(wav_filepath)[0]}.{output_extension(output_format)}"
+        if output_path == wav_filepath:
+            # Resampling a WAV: convert next to it, then replace it
+            converted_path = f"{os.path.splitext(wav_filepath)[0]}_{OUTPUT_SAMPLE_RATE}.wav"
+            if convert_audio_file(wav_filepath, converted_path, output_format):
+                os.replace(converted_path, wav_filepath)
+            else:
+                print(f"Resampling failed. Keeping {writer.sample_rate} Hz audio.")
+        elif convert_audio_file(wav_filepath, output_path, output_format):
+            audio_filepath = output_path
+            # Try to remove the WAV file after successful conversion
+            try:
+                os.remove(wav_filepath)
+                print(f"Temporary WAV file removed: {os.path.basename(wav_filepath)}")
+            except PermissionError:
+                print(f"Warning: Could not delete WAV file (file in use): {os.path.basename(wav_filepath)}")
+                print("The conversion was successful. You can manually delete the WAV file later.")
+            except Exception as e:
+                print(f"Warning: Could not delete WAV file: {str(e)}")
+        else:
+            # If conversion fails, keep the WAV file and return it
+            print(f"{output_format.upper()} conversion failed. Keeping WAV format.")
+    
+    final_file_size_mb = os.path.getsize(audio_filepath) / (1024 * 1024)
+    # What the same audio takes as 16-bit PCM WAV, the baseline for the other formats
+    pcm16_size_mb = writer.frames * 2 / (1024 * 1024)
+    size_text = f"{final_file_size_mb:.1f} MB"
+    if writer.seconds > 0:
+        size_text += f", {final_file_size_mb / writer.seconds * 3600:.0f} MB per hour"
+    if not audio_filepath.endswith('.wav') and final_file_size_mb > 0:
+        size_text += f", {pcm16_size_mb / final_file_size_mb:.1f}x smaller than 16-bit WAV"
+    format_name = output_format.upper() if audio_filepath.endswith(f".{output_extension(output_format)}") else 'WAV'
+    print(f"{format_name} file saved successfully! Size: {size_text}")
+    print(f"Final output: {os.path.basename(audio_filepath)}")
+    audio_filepath = output_store.register(audio_filepath, writer.seconds, voice)
+
+    # Check if file is too large for proper waveform display
+    is_large_file = final_file_size_mb > 50  # Consider files over 50MB as large
+    
+    if is_large_file:
+        print(f"⚠️  Large file generated ({final_file_size_mb:.1f} MB)")
+        print(f"📁 File location: {audio_filepath}")
+        print(f"💡 Note: Large files may not display waveforms properly in the browser.")
+        print(f"   You can access the full file directly from the outputs folder.")
+    
+    return audio_filepath, is_large_file
+
+def save_audio_file(audio_combined_numpy, output_format='WAV'):
+    """Write generated audio to the outputs folder, returning (audio_filepath, is_large_file)"""
+    writer = open_audio_file(output_format)
+    print(f"Saving audio file: {os.path.basename(writer.path)}")
+    writer.write(audio_combined_numpy)
+    return finish_audio_file(writer, output_format)
+
+# Checkpointed render jobs, one folder per job holding the partial WAV and its manifest
+JOBS_PATH = os.environ.get('KOKORO_JOBS_PATH', os.path.join(cache_base, 'jobs'))
+# How often a render waiting for the same job to finish elsewhere checks its lock
+JOB_LOCK_POLL_SECONDS = 0.5
+
+class RenderJob:
+    """A resumable render: a partial WAV file plus a manifest line for every finished segment.
+
+    The job id hashes the text, voice pack, speed, backend and model revision, so running
+    the same render again finds the job and continues after its last finished segment.
+    A job is held under an exclusive lock file from start() until it is suspended or
+    completed; a second render of the same job, in this process or another, waits for it.
+    """
+
+    def __init__(self, text, voice, pack, speed, backend):
+        self.header = {
+            'text_hash': hashlib.sha256(text.encode('utf-8')).hexdigest(),
+            'voice': voice,
+            'voice_hash': hashlib.sha256(pack.detach().cpu().to(torch.float32).contiguous().numpy().tobytes()).hexdigest(),
+            'speed': float(speed),
+            'backend': backend,
+            'model': MODEL_REVISION,
+            'sample_format': WAV_SAMPLE_FORMAT,
+        }
+        self.id = hashlib.sha256(json.dumps(self.header, sort_keys=True).encode('utf-8')).hexdigest()[:24]
+        self.folder = os.path.join(JOBS_PATH, self.id)
+        self.manifest_path = os.path.join(self.folder, 'manifest.jsonl')
+        self.wav_path = os.path.join(self.folder, 'audio.wav')
+        # Kept beside the job folder, which complete() deletes while the lock is held; the
+        # lock file itself is removed whenever the job is released
+        self.lock_path = os.path.join(JOBS_PATH, f"{self.id}.lock")
+        self.lock_file = None
+        self.segments = []
+        self.writer = None
+        self.manifest = None
+
+    def _lock(self, locked):
+        """Try to take the lock without blocking (raising OSError if it is held), or drop it"""
+        if os.name == 'nt':
+            import msvcrt
+            self.lock_file.seek(0)
+            msvcrt.locking(self.lock_file.fileno(), msvcrt.LK_NBLCK if locked else msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB if locked else fcntl.LOCK_UN)
+
+    def _acquire(self):
+        """Take the job's lock file, waiting while another render of the same job holds it.
+
+        The OS drops the lock when its holder exits, so a crashed render never blocks a resume.
+        """
+        os.makedirs(JOBS_PATH, exist_ok=True)
+        waiting = False
+        while True:
+            self.lock_file = open(self.lock_path, 'a+b')
+            try:
+                self._lock(True)
+                # The holder we waited for removes the file when it finishes; a lock on the
+                # removed file would not exclude a render that has since created a new one
+                if os.path.samestat(os.fstat(self.lock_file.fileno()), os.stat(self.lock_path)):
+                    return
+                self._lock(False)
+            except OSError:
+                if not waiting:
+                    print(f"Job {self.id} is already being rendered; waiting for it to finish")
+                    waiting = True
+                time.sleep(JOB_LOCK_POLL_SECONDS)
+            except BaseException:
+                self.lock_file.close()
+                self.lock_file = None
+                raise
+            self.lock_file.close()
+            self.lock_file = None
+
+    def _release(self):
+        """Remove the lock file and drop the lock, so finished jobs leave no lock files behind"""
+        if self.lock_file is None:
+            return
+        if os.name != 'nt':
+            # Unlinked while still held, so no other render can lock it in between
+            try:
+                os.remove(self.lock_path)
+            except OSError:
+                pass
+        try:
+            self._lock(False)
+        finally:
+            self.lock_file.close()
+            self.lock_file = None
+        if os.name == 'nt':
+            # Windows cannot remove an open file; a render waiting on it keeps it until it gets the lock
+            try:
+                os.remove(self.lock_path)
+            except OSError:
+                pass
+
+    def _load(self):
+        """Read the finished segments [(ps, frames)] whose audio is fully on disk"""
+        if not os.path.exists(self.manifest_path) or not os.path.exists(self.wav_path):
+            return []
+        segments = []
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                if json.loads(f.readline()) != self.header:
+                    return []
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A line torn by a crash mid-write
+                        break
+                    segments.append((entry['ps'], entry['frames']))
+        except Exception as e:
+            print(f"Warning: Could not read job manifest {self.manifest_path}: {str(e)}")
+            return []
+        available = (os.path.getsize(self.wav_path) - HEADER_BYTES) // SAMPLE_FORMATS[WAV_SAMPLE_FORMAT][0]
+        frames = 0
+        for i, (_, segment_frames) in enumerate(segments):
+            frames += segment_frames
+            if frames > available:
+                return segments[:i]
+        return segments
+
+    def start(self, segments):
+        """Skip the finished prefix of a phoneme segment iterator and return the rest.
+
+        Finished segments are only reused while their phonemes still match; from the first
+        difference on everything is rendered again.
+        """
+        self._acquire()
+        try:
+            return self._open(segments)
+        except BaseException:
+            self._release()
+            raise
+
+    def _open(self, segments):
+        # Read the manifest only under the lock: a render that held it may have extended
+        # the job, or completed it and removed the folder
+        self.segments = self._load()
+        segments = iter(segments)
+        done = 0
+        for ps, _ in self.segments:
+            next_ps = next(segments, None)
+            if next_ps != ps:
+                if next_ps is not None:
+                    segments = itertools.chain([next_ps], segments)
+                break
+            done += 1
+        self.segments = self.segments[:done]
+        frames = sum(segment_frames for _, segment_frames in self.segments)
+        
+        os.makedirs(self.folder, exist_ok=True)
+        # Rewrite the manifest so it matches the kept prefix exactly
+        temp_path = f"{self.manifest_path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(self.header) + '\n')
+            for ps, segment_frames in self.segments:
+                f.write(json.dumps({'ps': ps, 'frames': segment_frames}) + '\n')
+        os.replace(temp_path, self.manifest_path)
+        self.manifest = open(self.manifest_path, 'a', encoding='utf-8')
+        self.writer = WavWriter(self.wav_path, 24000, frames, WAV_SAMPLE_FORMAT)
+        if done:
+            print(f"Resuming job {self.id}: {done} segments ({self.writer.seconds:.1f} seconds of audio) already rendered")
+        else:
+            print(f"Starting job {self.id}")
+        return segments
+
+    def record(self, ps, audio):
+        """Append a finished segment's audio, then checkpoint it in the manifest"""
+        self.writer.write(audio)
+        # The audio must be on disk before the manifest claims it
+        self.writer.flush(sync=True)
+        self.manifest.write(json.dumps({'ps': ps, 'frames': audio.shape[-1]}) + '\n')
+        self.manifest.flush()
+        os.fsync(self.manifest.fileno())
+        self.segments.append((ps, audio.shape[-1]))
+
+    def suspend(self):
+        """Close the files and leave the job on disk to be resumed"""
+        self.manifest.close()
+        self.writer.close()
+        self._release()
+
+    def complete(self):
+        """Move the finished WAV into the outputs folder, delete the job and return the writer"""
+        self.manifest.close()
+        self.writer.close()
+        try:
+            audio_filepath = f"{new_output_stem()}.wav"
+            os.replace(self.wav_path, audio_filepath)
+            self.writer.path = audio_filepath
+            shutil.rmtree(self.folder, ignore_errors=True)
+        finally:
+            self._release()
+        return self.writer
+
+def generate_first(text, voice='af_heart', speed=1, output_format='WAV', backend=None, job=False):
+    """Render text to a file in the outputs folder, returning (audio_filepath, phoneme_sequence, is_large_file).
+
+    Each segment is appended to the WAV file as soon as it is synthesized, so memory use
+    stays flat however long the text is. With job=True every finished segment is also
+    checkpointed, and an interrupted render of the same input resumes where it stopped.
+    """
+    text = text.strip()
+    
+    voice, lang_code, pack = resolve_voice(voice)
+    backend = resolve_backend(backend)
+    
+    chunks = segment_text(text)
+    if not chunks:
+        raise EngineError("Please enter some text to synthesize.")
+    
+    ps_output = []
+    
+    def phoneme_segments():
+        for chunk in tqdm(chunks, desc="Processing chunks", ncols=100):
+            for _, ps in phonemize(lang_code, chunk):
+                ps_output.append(ps)
+                yield ps
+    
+    start_time = time.perf_counter()
+    segments = phoneme_segments()
+    if job:
+        job = RenderJob(text, voice, pack, speed, backend)
+        segments = job.start(segments)
+        writer = job.writer
+    else:
+        writer = open_audio_file(output_format)
+    print(f"Writing audio to: {writer.path}")
+    try:
+        phonemes = PhonemePrefetcher(segments)
+        for audio in synthesize_segments(phonemes, pack, speed, backend):
+            if job:
+                job.record(ps_output[len(job.segments)], audio)
+            else:
+                writer.write(audio)
+        phonemes.report(time.perf_counter() - start_time)
+    except BaseException:
+        if job:
+            job.suspend()
+            print(f"Job {job.id} stopped after {len(job.segments)} segments; run the same render again to resume it.")
+        else:
+            writer.abort()
+        raise
+    
+    if job:
+        writer = job.complete()
+    
+    phoneme_sequence = '\n'.join(ps_output)
+
+    audio_filepath, is_large_file = finish_audio_file(writer, output_format, voice)
+    
+    print(f"🎵 Generation complete! Total processing time for {len(chunks)} chunks.")
+    
+    return audio_filepath, phoneme_sequence, is_large_file
+
+# Target size in estimated phonemes of the segments the first sentence of a stream is split into
+STREAM_FIRST_SEGMENT_CHARS = 100
+
+def generate_first_stream(text, voice='af_heart', speed=1, output_format='WAV', backend=None):
+    """Generator variant of generate_first that yields each segment's audio as soon as it is ready.
+
+    The final file is assembled on a background thread while segments are still streaming;
+    the generator returns (audio_filepath, phoneme_sequence, is_large_file) when done.
+    """
+    text = text.strip()
+    
+    voice, lang_code, pack = resolve_voice(voice)
+    backend = resolve_backend(backend)
+    
+    # The first sentence is segmented on its own, with a smaller target, so the first audio
+    # is ready after one short segment instead of a full one
+    first_sentence = _split_after(text, _SENTENCE_BREAK)[0] if text else ''
+    chunks = segment_text(first_sentence, STREAM_FIRST_SEGMENT_CHARS) + segment_text(text[len(first_sentence):])
+    if not chunks:
+        raise EngineError("Please enter some text to synthesize.")
+    
+    ps_output = []
+    segments = queue.Queue()
+    # Queued instead of None when the stream stops early, so the partial file is discarded
+    aborted = object()
+    
+    def assemble():
+        writer = open_audio_file(output_format)
+        try:
+            while (audio := segments.get()) is not None:
+                if audio is aborted:
+                    writer.abort()
+                    return None
+                writer.write(audio)
+        except BaseException:
+            writer.abort()
+            raise
+        return finish_audio_file(writer, output_format, voice)
+    
+    def report_abandoned(future):
+        if future.exception() is not None:
+            print(f"Warning: Could not write the cancelled stream's audio file: {str(future.exception())}")
+    
+    assembler = ThreadPoolExecutor(max_workers=1)
+    assembled = assembler.submit(assemble)
+    start_time = time.perf_counter()
+    def phoneme_segments():
+        for chunk in chunks:
+            for _, ps in phonemize(lang_code, chunk):
+                yield ps
+    
+    completed = False
+    try:
+        for ps in PhonemePrefetcher(phoneme_segments()):
+            if assembled.done():
+                # The writer failed; raise its error now rather than after the whole render
+                assembled.result()
+            audio = synthesize_window([ps], pack, speed, backend)[0]
+            ps_output.append(ps)
+            segments.put(audio)
+            if len(ps_output) == 1:
+                print(f"⚡ Time to first audio: {time.perf_counter() - start_time:.2f} seconds")
+            yield audio
+        completed = True
+    finally:
+        # An error or a closed generator (client disconnect, cancel) must not register a truncated file
+        segments.put(None if completed else aborted)
+        if not completed and not assembled.done():
+            assembled.add_done_callback(report_abandoned)
+        assembler.shutdown(wait=False)
+    
+    audio_filepath, is_large_file = assembled.result()
+    print(f"🎵 Streaming generation complete! {len(ps_output)} segments in {time.perf_counter() - start_time:.1f} seconds.")
+    
+    return audio_filepath, '\n'.join(ps_output), is_large_file
+
+# Add voice mixing functionality
+def is_voice_formula(voice):
+    """Whether a voice argument is an inline mix such as 'af_heart * 0.7 + bf_emma * 0.3'"""
+    return '*' in voice or '+' in voice
+
+def parse_voice_formula(formula):
+    """Parse 'voice * weight + ...' into a normalized, sorted list of (voice_id, weight)"""
+    if not formula.strip():
+        raise ValueError("Empty voice formula")
+    
+    weights = {}
+    for term in formula.split('+'):
+        parts = term.strip().split('*')
+        if len(parts) != 2:
+            raise ValueError(f"Invalid term format: {term.strip()}")
+        
+        voice_name = parts[0].strip()
+        weight = float(parts[1].strip())
+        
+        if voice_name not in voice_store and voice_name not in CHOICES.values() and voice_name not in custom_voice_index():
+            raise ValueError(f"Unknown voice: {voice_name}")
+        weights[voice_name] = weights.get(voice_name, 0) + weight
+    
+    total = sum(weights.values())
+    if total <= 0:
+        raise ValueError("Voice weights must add up to more than 0")
+    return [(voice_name, weight / total) for voice_name, weight in sorted(weights.items())]
+
+def mix_voices(terms):
+    """Blend [(voice_id, weight)] into one pack with a single weighted reduction"""
+    voices = [voice_name for voice_name, _ in terms]
+    weights = torch.tensor([weight for _, weight in terms], dtype=torch.float32)
+    stacked = voice_bank.stacked() if voice_bank is not None else None
+    if stacked is not None and all(
+        voice_name in stacked[0] and voice_bank.source(voice_name) == voice_source(voice_name, custom_voice_index().get(voice_name))
+        for voice_name in voices
+    ):
+        # Every voice is current in the bank: gather their rows straight from the mapping
+        rows, bank = stacked
+        packs = bank[torch.tensor([rows[voice_name] for voice_name in voices])]
+    else:
+        packs = torch.stack([get_voice_pack(voice_name) for voice_name in voices])
+    return torch.tensordot(weights, packs, dims=1)
+
+def get_mixed_voice(formula):
+    """Return (voice_id, pack) for an inline formula, memoized by its normalized form"""
+    try:
+        terms = parse_voice_formula(formula)
+    except ValueError as e:
+        raise EngineError(f"Invalid voice formula: {str(e)}")
+    voice_id = ' + '.join(f"{voice_name} * {weight:.6g}" for voice_name, weight in terms)
+    pack = voice_store.get(voice_id)
+    if pack is None:
+        start_time = time.perf_counter()
+        pack = mix_voices(terms)
+        voice_store.put(voice_id, pack, time.perf_counter() - start_time)
+    return voice_id, pack
+
+def get_new_voice(formula, custom_name=""):
+    """Save a mixed voice to the custom_voices folder as a .pt file"""
+    try:
+        _, weighted_voices = get_mixed_voice(formula)
+        
+        # Create a filename with custom name or timestamp if no name provided
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        if custom_name and custom_name.strip():
+            # Sanitize custom name (remove spaces and special characters)
+            custom_name = ''.join(c for c in custom_name if c.isalnum() or c == '_')
+            voice_name = f"{custom_name}"
+        else:
+            voice_name = f"mixed_{timestamp}"
+            
+        voice_pack_name = os.path.join(custom_voices_folder, f"{voice_name}.pt")
+        
+        torch.save(weighted_voices.clone(), voice_pack_name)
+        return voice_pack_name, voice_name
+    except Exception as e:
+        raise EngineError(f"Failed to create voice: {str(e)}")
+
+# Helper function to generate audio without saving to disk
+def generate_audio_in_memory(text, voice, speed=1, backend=None):
+    """Generate audio without saving intermediate files"""
+    text = text.strip()
+    
+    voice, lang_code, pack = resolve_voice(voice)
+    backend = resolve_backend(backend)
+    
+    chunks = segment_text(text)
+    
+    audio_output = []
+    
+    def phoneme_segments():
+        for chunk in chunks:
+            for _, ps in phonemize(lang_code, chunk):
+                yield ps
+    
+    for audio in synthesize_segments(PhonemePrefetcher(phoneme_segments()), pack, speed, backend):
+        audio_output.append(audio)
+    
+    # Return combined audio as tensor
+    audio_combined = torch.cat(audio_output, dim=-1)
+    return audio_combined
+
+# Function to parse conversation script
+def parse_conversation_script(script_text):
+    """Parse a conversation script and extract speakers and their lines"""
+    if not script_text.strip():
+        return []
+    
+    lines = script_text.strip().split('\n')
+    conversation = []
+    current_speaker = None
+    current_text = []
+    
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+            
+        # Check if line starts with "Speaker X:" pattern
+        if ':' in line:
+            # Check if it's a speaker line
+            potential_speaker = line.split(':', 1)[0].strip()
+            if potential_speaker.lower().startswith('speaker') or len(potential_speaker.split()) <= 3:
+                # Save previous speaker's text if any
+                if current_speaker and current_text:
+                    conversation.append((current_speaker, ' '.join(current_text)))
+                
+                # Start new speaker
+                current_speaker = potential_speaker
+                current_text = [line.split(':', 1)[1].strip()]
+            else:
+                # Not a speaker line, add to current text
+                if current_speaker:
+                    current_text.append(line)
+        else:
+            # Continuation of current speaker's text
+            if current_speaker:
+                current_text.append(line)
+    
+    # Add the last speaker's text
+    if current_speaker and current_text:
+        conversation.append((current_speaker, ' '.join(current_text)))
+    
+    return conversation
+
+def trim_silence(audio_tensor, threshold=0.01):
+    """Trim silence from the beginning and end of audio"""
+    # Find first and last non-silent samples
+    non_silent = torch.abs(audio_tensor) > threshold
+    if not torch.any(non_silent):
+        return audio_tensor  # Return original if all silent
+    
+    # Find first and last non-silent indices
+    first_sound = torch.where(non_silent)[0][0]
+    last_sound = torch.where(non_silent)[0][-1]
+    
+    # Trim with small padding to avoid cutting off audio
+    padding = int(24000 * 0.05)  # 50ms padding
+    start = max(0, first_sound - padding)
+    end = min(len(audio_tensor), last_sound + padding)
+    
+    return audio_tensor[start:end]
+
+def batch_convert_text_files_with_voices(files, speed, output_format, *voice_assignments):
+    """Convert multiple text files to audio using individual voice settings for each file.
+
+    For compressed formats each file is synthesized to WAV and handed to an EncoderPool, so the next file's
+    synthesis overlaps with the previous files' encodes.
+    """
+    if not files:
+        raise EngineError("Please upload at least one text file.")
+    
+    results = [None] * len(files)
+    audio_files = [None] * len(files)  # Store paths to generated audio files
+    total_files = len(files)
+    # Compressed formats are encoded in the background while the next file is synthesized
+    encoder_pool = EncoderPool() if output_format.upper() in OUTPUT_FORMATS and output_format.upper() != 'WAV' else None
+    encodes = []
+    
+    print(f"Starting batch conversion of {total_files} files...")
+    
+    def record_result(i, file_path, voice, new_audio_path):
+        new_filename = os.path.basename(new_audio_path)
+        file_size_mb = os.path.getsize(new_audio_path) / (1024 * 1024)
+        results[i] = f"✅ {os.path.basename(file_path)} → {new_filename} ({file_size_mb:.1f} MB) [Voice: {voice}]"
+        audio_files[i] = new_audio_path
+        print(f"✅ Completed: {new_filename} with voice: {voice}")
+    
+    for i, file_path in enumerate(files):
+        try:
+            print(f"Processing file {i+1}/{total_files}: {os.path.basename(file_path)}")
+            
+            # Read the text file
+            with open(file_path, 'r', encoding='utf-8') as f:
+                text_content = f.read().strip()
+            
+            if not text_content:
+                print(f"Skipping empty file: {os.path.basename(file_path)}")
+                results[i] = f"❌ {os.path.basename(file_path)}: Empty file"
+                continue
+            
+            # Get the voice for this specific file
+            voice = voice_assignments[i] if i < len(voice_assignments) and voice_assignments[i] else list(update_voice_choices().keys())[0]
+            
+            # Generate audio for this text with the assigned voice. Checkpointed, so a batch
+            # restarted after a crash resumes a half-rendered file
+            audio_path, _, _ = generate_first(text_content, voice, speed, 'WAV' if encoder_pool else output_format, job=True)
+            
+            # Rename the output file to match the input filename
+            input_filename = os.path.splitext(os.path.basename(file_path))[0]
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            
+            new_filename = f"{input_filename}_{timestamp}.{output_extension(output_format)}"
+            
+            new_audio_path = os.path.join(output_folder, new_filename)
+            
+            if not os.path.exists(audio_path):
+                results[i] = f"❌ {os.path.basename(file_path)}: Audio generation failed"
+            elif encoder_pool:
+                # Encode in the background and start on the next file. The WAV leaves the
+                # output store so it cannot be evicted while it waits
+                duration = output_store.release(audio_path)
+                encodes.append((i, file_path, voice, duration, encoder_pool.submit(audio_path, new_audio_path, output_format)))
+                print(f"Queued {new_filename} for encoding ({encoder_pool.depth()} waiting)")
+            else:
+                # Rename the generated file
+                os.rename(audio_path, new_audio_path)
+                output_store.move(audio_path, new_audio_path)
+                record_result(i, file_path, voice, new_audio_path)
+                
+        except Exception as e:
+            error_msg = f"❌ {os.path.basename(file_path)}: {str(e)}"
+            results[i] = error_msg
+            print(f"Error processing {os.path.basename(file_path)}: {str(e)}")
+    
+    # Wait for the encoders to drain
+    for i, file_path, voice, duration, future in encodes:
+        try:
+            record_result(i, file_path, voice, output_store.register(future.result(), duration, voice))
+        except Exception as e:
+            results[i] = f"❌ {os.path.basename(file_path)}: Encoding failed: {str(e)}"
+            print(f"Error encoding {os.path.basename(file_path)}: {str(e)}")
+    if encoder_pool:
+        encoder_pool.shutdown()
+        stats = encoder_pool.stats()
+        print(f"Encoder pool: {stats['encoded']} files on {stats['workers']} workers, "
+              f"encode {stats['encode_seconds_mean']:.1f}s mean / {stats['encode_seconds_p95']:.1f}s p95, "
+              f"max {stats['max_depth_seen']} waiting, synthesis blocked {stats['blocked_seconds']:.1f}s")
+    
+    # Create summary
+    successful = len([r for r in results if r.startswith("✅")])
+    failed = len([r for r in results if r.startswith("❌")])
+    
+    summary = f"Batch conversion completed!\n"
+    summary += f"✅ Successful: {successful}/{total_files}\n"
+    summary += f"❌ Failed: {failed}/{total_files}\n\n"
+    summary += "Results:\n" + "\n".join(results)
+    
+    print(f"Batch conversion completed: {successful} successful, {failed} failed")
+    
+    return summary, audio_files
+
+# Script lines synthesized concurrently. Their segments meet in the inference scheduler,
+# which batches them together
+CONVERSATION_WORKERS = int(os.environ.get('KOKORO_CONVERSATION_WORKERS', 4))
+
+def generate_conversation_from_script(script_text, speaker_voices, pause_duration, default_speed, output_format='WAV'):
+    """Generate conversation audio from a script with assigned voices.
+
+    Lines are synthesized concurrently on CONVERSATION_WORKERS threads (one when the
+    inference scheduler is disabled) and written to the output in script order as soon as
+    every earlier line is done. G2P is not thread-safe, so each line is phonemized on this
+    thread before it is handed to a worker.
+    """
+    conversation = parse_conversation_script(script_text)
+    
+    if not conversation:
+        raise EngineError("No conversation found. Please enter a script in the format:\nSpeaker 1: Hello\nSpeaker 2: Hi there")
+    
+    # Get unique speakers
+    speakers = list(set([speaker for speaker, _ in conversation]))
+    
+    # Check if all speakers have assigned voices
+    missing_voices = [speaker for speaker in speakers if speaker not in speaker_voices or not speaker_voices[speaker]]
+    if missing_voices:
+        raise EngineError(f"Please assign voices for: {', '.join(missing_voices)}")
+    
+    # Check custom voices against the voice index before any line is dispatched
+    custom_voices = get_custom_voices()
+    for speaker in speakers:
+        voice = speaker_voices[speaker]
+        if voice.startswith('👤 Custom:') and voice not in custom_voices:
+            custom_voice_file = f"{voice.replace('👤 Custom: ', '')}.pt"
+            available_files = sorted(f"{voice_id[len('custom_'):]}.pt" for voice_id in custom_voices.values())
+            raise EngineError(f"Custom voice file '{custom_voice_file}' not found in custom_voices folder.\nAvailable custom voice files: {available_files}")
+    
+    voices = {}
+    for speaker in speakers:
+        try:
+            voices[speaker] = resolve_voice(speaker_voices[speaker])
+        except Exception as e:
+            raise EngineError(f"Error generating audio for {speaker}: {str(e)}")
+    backend = resolve_backend()
+    
+    lines = [(i, speaker, text) for i, (speaker, text) in enumerate(conversation) if text.strip()]
+    conversation_script = [f"{speaker}: {text}" for _, speaker, text in lines]
+    # Without the scheduler nothing serializes model calls, so lines run one at a time
+    workers = max(1, CONVERSATION_WORKERS) if SCHEDULER_ENABLED else 1
+    print(f"Generating {len(lines)} lines on {workers} workers")
+    
+    progress = tqdm(total=len(lines), desc="Lines", ncols=100)
+    
+    def phonemize_line(speaker, text):
+        _, lang_code, _ = voices[speaker]
+        return [ps for chunk in segment_text(text.strip()) for _, ps in phonemize(lang_code, chunk)]
+    
+    def render_line(speaker, segments):
+        # Generate audio for this speaker in memory (no intermediate files saved)
+        _, _, pack = voices[speaker]
+        audio_tensor = torch.cat(list(synthesize_segments(segments, pack, default_speed, backend)), dim=-1)
+        progress.update(1)
+        return audio_tensor
+    
+    # Lines are written to the output as they are generated; ffmpeg encodes alongside
+    writer = None
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="conversation")
+    # Only a bounded window of lines runs ahead of the one being written, which keeps the
+    # audio held in memory bounded however long the script is
+    window = workers * 2
+    pending = deque()
+    upcoming = iter(lines)
+    try:
+        while True:
+            while len(pending) < window and (line := next(upcoming, None)) is not None:
+                i, speaker, text = line
+                try:
+                    segments = phonemize_line(speaker, text)
+                except Exception as e:
+                    raise EngineError(f"Error generating audio for {speaker}: {str(e)}")
+                pending.append((i, speaker, executor.submit(render_line, speaker, segments)))
+            if not pending:
+                break
+            i, speaker, future = pending.popleft()
+            try:
+                audio_tensor = future.result()
+            except Exception as e:
+                raise EngineError(f"Error generating audio for {speaker}: {str(e)}")
+            
+            # Normalize audio
+            if audio_tensor.max() > 1.0:
+                audio_tensor = audio_tensor / audio_tensor.max()
+            
+            # Trim silence from individual audio clips
+            audio_tensor = trim_silence(audio_tensor)
+            
+            # Handle pause between speakers (can be negative for overlap)
+            pause_audio = None
+            if i < len(conversation) - 1:
+                if pause_duration > 0:
+                    # Add silence
+                    pause_samples = int(24000 * pause_duration)
+                    pause_audio = torch.zeros(pause_samples)
+                elif pause_duration < 0:
+                    # Negative pause means trim from the end of current audio
+                    trim_samples = int(24000 * abs(pause_duration))
+                    if len(audio_tensor) > trim_samples:
+                        audio_tensor = audio_tensor[:-trim_samples]
+                # If pause_duration == 0, add no pause (direct concatenation)
+            
+            if writer is None:
+                writer = open_audio_file(output_format, prefix='conversation')
+            writer.write(audio_tensor)
+            if pause_audio is not None:
+                writer.write(pause_audio)
+    except BaseException:
+        for _, _, future in pending:
+            future.cancel()
+        if writer is not None:
+            writer.abort()
+        raise
+    finally:
+        executor.shutdown(wait=False)
+        progress.close()
+    
+    # Finish the combined conversation file
+    if writer is not None:
+        conversation_filepath, _ = finish_audio_file(writer, output_format, ', '.join(sorted(set(speaker_voices.values()))))
+        conversation_filename = os.path.basename(conversation_filepath)
+        
+        # Create conversation script text
+        script_text = "\n".join(conversation_script)
+        
+        print(f"🎬 Conversation generation complete!")
+        print(f"Only final conversation file saved: {conversation_filename}")
+        print(f"No intermediate speaker files were saved.")
+        
+        return conversation_filepath, script_text
+    else:
+        raise EngineError("No audio generated. Please check your inputs.")
+
+# Function to generate conversation audio
+def generate_conversation(speaker1_name, speaker1_voice, speaker1_text, speaker1_speed,
+                         speaker2_name, speaker2_voice, speaker2_text, speaker2_speed,
+                         speaker3_name, speaker3_voice, speaker3_text, speaker3_speed,
+                         speaker4_name, speaker4_voice, speaker4_text, speaker4_speed,
+                         speaker5_name, speaker5_voice, speaker5_text, speaker5_speed,
+                         pause_duration, output_format='WAV'):
+    """Render up to five speakers in turn into one file, returning (conversation_filepath, script_text).
+
+    Each speaker is synthesized in memory and written straight into the output file, so no
+    per-speaker files are created.
+    """
+    
+    # Collect all speakers and their data
+    speakers = [
+        (speaker1_name, speaker1_voice, speaker1_text, speaker1_speed),
+        (speaker2_name, speaker2_voice, speaker2_text, speaker2_speed),
+        (speaker3_name, speaker3_voice, speaker3_text, speaker3_speed),
+        (speaker4_name, speaker4_voice, speaker4_text, speaker4_speed),
+        (speaker5_name, speaker5_voice, speaker5_text, speaker5_speed)
+    ]
+    
+    # Filter out speakers with no text
+    active_speakers = [(name, voice, text, speed) for name, voice, text, speed in speakers if text.strip()]
+    
+    if not active_speakers:
+        raise EngineError("Please add text for at least one speaker.")
+    
+    conversation_script = []
+    writer = open_audio_file(output_format, prefix='conversation')
+    
+    # Generate pause audio (silence)
+    pause_samples = int(24000 * pause_duration)  # 24kHz sample rate
+    pause_audio = torch.zeros(pause_samples)
+    
+    for i, (name, voice, text, speed) in enumerate(active_speakers):
+        # Update conversation script
+        speaker_name = name.strip() if name.strip() else f"Speaker {i+1}"
+        conversation_script.append(f"{speaker_name}: {text}")
+        
+        # Generate audio for this speaker in memory (no intermediate files saved)
+        try:
+            audio_tensor = generate_audio_in_memory(text, voice, speed)
+            
+            # Normalize audio
+            if audio_tensor.max() > 1.0:
+                audio_tensor = audio_tensor / audio_tensor.max()
+            
+            writer.write(audio_tensor)
+            
+            # Add pause after each speaker (except the last one)
+            if i < len(active_speakers) - 1 and pause_samples > 0:
+                writer.write(pause_audio)
+                
+        except Exception as e:
+            writer.abort()
+            raise EngineError(f"Error generating audio for {speaker_name}: {str(e)}")
+    
+    # Finish the combined conversation file
+    conversation_filepath, _ = finish_audio_file(writer, output_format, ', '.join(voice for _, voice, _, _ in active_speakers))
+    
+    # Create conversation script text
+    script_text = "\n".join(conversation_script)
+    
+    print(f"🎬 Conversation generation complete!")
+    print(f"Speakers processed: {len(active_speakers)}")
+    
+    return conversation_filepath, script_text
+
+def debug_custom_voices():
+    """Debug function to list custom voice files"""
+    print("\n=== CUSTOM VOICES DEBUG ===")
+    print(f"Custom voices folder: {custom_voices_folder}")
+    print(f"Folder exists: {os.path.exists(custom_voices_folder)}")
+    
+    if os.path.exists(custom_voices_folder):
+        all_files = os.listdir(custom_voices_folder)
+        pt_files = [f for f in all_files if f.endswith('.pt')]
+        print(f"All files in folder: {all_files}")
+        print(f"PT files found: {pt_files}")
+        
+        # Check what get_custom_voices() returns
+        custom_voices_dict = get_custom_voices()
+        print(f"get_custom_voices() result: {custom_voices_dict}")
+        
+        # Check resident voices
+        custom_loaded = [voice for voice in voice_store.resident() if voice.startswith('custom_')]
+        print(f"Resident custom voices: {custom_loaded}")
+    else:
+        print("Custom voices folder does not exist!")
+    print("=== END DEBUG ===\n")
+
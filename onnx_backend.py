@@ -0,0 +1,77 @@
+"""ONNX Runtime backend for the Kokoro model.
+
+export_onnx() converts a KModel into an ONNX graph with a dynamic phoneme-length axis,
+and OnnxModel runs that graph on the ONNX Runtime CPU provider behind the same
+model(ps, ref_s, speed) call that KModel offers. onnxruntime is optional; exporting
+also needs the onnx package.
+"""
+import os
+import time
+import threading
+import torch
+import numpy as np
+
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
+
+# Graph optimization levels accepted by KOKORO_ONNX_OPT_LEVEL
+OPT_LEVELS = {
+    'disable': 'ORT_DISABLE_ALL',
+    'basic': 'ORT_ENABLE_BASIC',
+    'extended': 'ORT_ENABLE_EXTENDED',
+    'all': 'ORT_ENABLE_ALL',
+}
+
+def export_onnx(model, path, opset_version=20):
+    """Export a KModel created with disable_complex=True to path.
+
+    The vocoder's complex STFT cannot be exported, which is why the model must be
+    built with kokoro's real-valued STFT. The file is written atomically.
+    """
+    from kokoro.model import KModelForONNX
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    input_ids = torch.LongTensor([[0, *list(model.vocab.values())[:32], 0]])
+    ref_s = torch.zeros(1, 256)
+    speed = torch.ones(1)
+    temp_path = f"{path}.{threading.get_ident()}.tmp"
+    print(f"Exporting ONNX model to {path}...")
+    start_time = time.perf_counter()
+    torch.onnx.export(
+        KModelForONNX(model).eval(), (input_ids, ref_s, speed), temp_path,
+        input_names=['input_ids', 'ref_s', 'speed'],
+        output_names=['waveform', 'duration'],
+        dynamic_axes={'input_ids': {1: 'tokens'}, 'waveform': {0: 'samples'}, 'duration': {0: 'tokens'}},
+        opset_version=opset_version,
+        dynamo=False,
+    )
+    os.replace(temp_path, path)
+    print(f"ONNX export finished in {time.perf_counter() - start_time:.1f} seconds")
+    return path
+
+class OnnxModel:
+    """Runs an exported Kokoro graph with ONNX Runtime, called like KModel(ps, ref_s, speed)"""
+
+    def __init__(self, path, vocab, threads=0, opt_level='all'):
+        if ort is None:
+            raise ImportError("onnxruntime is not installed. Run: pip install onnxruntime")
+        if opt_level not in OPT_LEVELS:
+            raise ValueError(f"Unknown ONNX optimization level '{opt_level}'. Choose one of: {', '.join(OPT_LEVELS)}")
+        options = ort.SessionOptions()
+        options.graph_optimization_level = getattr(ort.GraphOptimizationLevel, OPT_LEVELS[opt_level])
+        if threads > 0:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.vocab = vocab
+        self.path = path
+
+    def __call__(self, ps, ref_s, speed=1):
+        input_ids = [i for i in map(self.vocab.get, ps) if i is not None]
+        inputs = {
+            'input_ids': np.array([[0, *input_ids, 0]], dtype=np.int64),
+            'ref_s': ref_s.detach().cpu().reshape(1, -1).numpy().astype(np.float32),
+            'speed': np.array([speed], dtype=np.float32),
+        }
+        waveform, _ = self.session.run(None, inputs)
+        return torch.from_numpy(waveform)
@@ -0,0 +1,152 @@
+"""Consolidated voice bank: every voice pack in one memory-mapped file.
+
+File layout:
+    8 bytes   magic b'KOKOVB01'
+    8 bytes   little-endian length of the JSON index
+    N bytes   JSON index {voice: {"offset", "shape", "source"}}, offsets in float32 units
+    padding   zeros up to a 64-byte boundary
+    data      every pack as contiguous little-endian float32
+
+The data region is mapped read-only, so a voice lookup is a view into the page cache
+and several processes opening the same bank share one copy. Windows cannot replace a
+file while it is mapped, so there the data region is read into memory instead. "source" fingerprints what
+a pack was built from, so a changed voice file is noticed and reloaded. When every pack
+has the same shape the data region doubles as one stacked (voices, *shape) tensor.
+"""
+import os
+import json
+import struct
+import threading
+import warnings
+import numpy as np
+import torch
+
+MAGIC = b'KOKOVB01'
+ALIGN = 64
+# Whether the data region is memory-mapped; see the module docstring
+MAP_FILES = os.name != 'nt'
+
+def write_voice_bank(path, packs, sources):
+    """Write packs ({voice: tensor}) and their source fingerprints to path atomically"""
+    index = {}
+    offset = 0
+    arrays = []
+    for voice, pack in packs.items():
+        array = np.ascontiguousarray(pack.detach().cpu().numpy(), dtype='<f4')
+        index[voice] = {'offset': offset, 'shape': list(array.shape), 'source': sources.get(voice)}
+        offset += array.size
+        arrays.append(array)
+    header = json.dumps(index).encode('utf-8')
+    data_start = -(-(len(MAGIC) + 8 + len(header)) // ALIGN) * ALIGN
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temp_path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<Q', len(header)))
+            f.write(header)
+            f.write(b'\0' * (data_start - f.tell()))
+            for array in arrays:
+                f.write(array.tobytes())
+        # On POSIX, existing mappings of the old file stay valid after the replace
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+class VoiceBank:
+    """Read-only view of a voice bank file, rewritten when voices are added"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # (index, data, stacked) is swapped as one value so readers never mix an old index
+        # with new data
+        self.mapping = ({}, None, None)
+        self.open()
+
+    @property
+    def index(self):
+        return self.mapping[0]
+
+    def open(self):
+        """Map the bank file, or start empty if it is missing or unreadable"""
+        if not os.path.exists(self.path):
+            self.mapping = ({}, None, None)
+            return
+        try:
+            with open(self.path, 'rb') as f:
+                if f.read(len(MAGIC)) != MAGIC:
+                    raise ValueError("not a voice bank file")
+                header_length, = struct.unpack('<Q', f.read(8))
+                index = json.loads(f.read(header_length).decode('utf-8'))
+            data_start = -(-(len(MAGIC) + 8 + header_length) // ALIGN) * ALIGN
+            data = None
+            if os.path.getsize(self.path) > data_start:
+                if MAP_FILES:
+                    data = np.memmap(self.path, dtype='<f4', mode='r', offset=data_start)
+                else:
+                    data = np.fromfile(self.path, dtype='<f4', offset=data_start)
+            self.mapping = (index, data, self._stack(index, data))
+        except Exception as e:
+            print(f"Warning: Could not open voice bank {self.path}: {str(e)}")
+            self.mapping = ({}, None, None)
+
+    @staticmethod
+    def _stack(index, data):
+        """View the data region as ({voice: row}, (voices, *shape) tensor) if all shapes match"""
+        shapes = {tuple(entry['shape']) for entry in index.values()}
+        if data is None or len(shapes) != 1:
+            return None
+        shape = shapes.pop()
+        size = int(np.prod(shape))
+        rows = {voice: entry['offset'] // size for voice, entry in index.items()}
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', UserWarning)
+            stacked = torch.from_numpy(data[:len(rows) * size].reshape(len(rows), *shape))
+        return rows, stacked
+
+    def stacked(self):
+        """Return ({voice: row}, stacked tensor) for the whole bank, or None if shapes differ"""
+        return self.mapping[2]
+
+    def source(self, voice):
+        entry = self.mapping[0].get(voice)
+        return entry['source'] if entry else None
+
+    def get(self, voice, source=None):
+        """Return the mapped pack for voice, or None if it is missing or its source changed"""
+        index, data, _ = self.mapping
+        entry = index.get(voice)
+        if entry is None or entry['source'] != source:
+            return None
+        size = int(np.prod(entry['shape']))
+        array = data[entry['offset']:entry['offset'] + size].reshape(entry['shape'])
+        with warnings.catch_warnings():
+            # The mapping is read-only; packs are only ever read
+            warnings.simplefilter('ignore', UserWarning)
+            return torch.from_numpy(array)
+
+    def add(self, packs, sources):
+        """Add or replace packs in the bank file and return their mapped views"""
+        with self.lock:
+            # Pick up voices other processes have added since this bank was opened
+            self.open()
+            if all(voice in self.index and self.source(voice) == sources.get(voice) for voice in packs):
+                # Already written, e.g. by another process
+                return {voice: self.get(voice, sources.get(voice)) for voice in packs}
+            merged = {voice: self.get(voice, entry['source']) for voice, entry in self.index.items() if voice not in packs}
+            merged.update(packs)
+            merged_sources = {voice: entry['source'] for voice, entry in self.index.items()}
+            merged_sources.update(sources)
+            write_voice_bank(self.path, merged, merged_sources)
+            self.open()
+            return {voice: self.get(voice, sources.get(voice)) for voice in packs}
+
+    def stats(self):
+        index, data, _ = self.mapping
+        return {
+            'voices': len(index),
+            'size_mb': data.nbytes / (1024 * 1024) if data is not None else 0.0,
+        }